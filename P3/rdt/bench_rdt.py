@@ -0,0 +1,104 @@
+import argparse
+import ipaddress
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import time
+
+from P3.rdt.rdt import ReliableDT, MyPacket, CONGESTION_CONTROLS, FixedWindow
+
+
+def receive(router_addr, port, recv_window, max_packet_len, idle_timeout, result):
+    """
+    Receiver process: accept one connection and report the number of bytes received
+    """
+    rdt = ReliableDT(router_addr, max_packet_len=max_packet_len, recv_window=recv_window)
+    rdt.timeout = idle_timeout
+    rdt.bind(('localhost', port))
+    try:
+        rdt.accept()
+        result.put(len(rdt.recvall()))
+    finally:
+        rdt.conn.close()
+
+
+def run(router_addr, port, data, mss, congestion, recv_window, max_packet_len, idle_timeout):
+    """
+    Send data through the router with the given segment size and congestion control
+    :return: (seconds until every packet was acknowledged, bytes the receiver got)
+    """
+    result = multiprocessing.Queue()
+    receiver = multiprocessing.Process(target=receive,
+                                       args=(router_addr, port, recv_window, max_packet_len, idle_timeout, result))
+    receiver.start()
+    time.sleep(0.2)
+    if not receiver.is_alive():
+        raise RuntimeError("Receiver did not start, is port %d in use?" % port)
+
+    rdt = ReliableDT(router_addr, max_packet_len=max_packet_len, mss=mss, congestion=congestion)
+    try:
+        rdt.connect((ipaddress.ip_address('127.0.0.1'), port))
+        start = time.perf_counter()
+        rdt.sendall(data)
+        elapsed = time.perf_counter() - start
+    finally:
+        rdt.conn.close()
+    received = result.get(timeout=60)
+    receiver.join()
+    return elapsed, received
+
+
+# Usage: python -m P3.rdt.bench_rdt [--router P3/example/router/source/router] [--drop-rate 0.05] [--max-delay 5ms]
+#                                   [--mss 2 64 256 512 1007] [--bytes 200000] [--congestion reno fixed]
+#                                   [--fixed-window 64] [--recv-window 1024]
+# Without --router a router must already be listening on --router-port.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--router", help="router binary to start, e.g. built with 'go build router.go'")
+    parser.add_argument("--router-port", type=int, default=3000)
+    parser.add_argument("--drop-rate", help="drop rate of the started router", default="0")
+    parser.add_argument("--max-delay", help="max delay of the started router", default="0")
+    parser.add_argument("--port", help="port of the receiver", type=int, default=8007)
+    parser.add_argument("--mss", help="payload bytes per packet to compare", type=int, nargs="+",
+                        default=[2, 64, 256, 512, MyPacket.MAX_LEN - MyPacket.MIN_LEN])
+    parser.add_argument("--bytes", help="bytes sent per run", type=int, default=200000)
+    parser.add_argument("--congestion", help="congestion controls to compare", nargs="+",
+                        choices=sorted(CONGESTION_CONTROLS), default=["reno", "fixed"])
+    parser.add_argument("--fixed-window", help="packets in flight with --congestion fixed", type=int, default=64)
+    parser.add_argument("--recv-window", help="receive window in packets advertised by the receiver", type=int,
+                        default=1024)
+    parser.add_argument("--max-packet-len", help="max packet size proposed in the handshake", type=int,
+                        default=MyPacket.MAX_LEN)
+    parser.add_argument("--idle-timeout", help="seconds without packets before the receiver stops",
+                        type=float, default=0.5)
+    args = parser.parse_args()
+
+    router = None
+    if args.router:
+        # the router writes router.log into its working directory
+        log_dir = tempfile.mkdtemp(prefix='rdt-router-')
+        router = subprocess.Popen([os.path.abspath(args.router), '--port', str(args.router_port),
+                                   '--drop-rate', args.drop_rate, '--max-delay', args.max_delay],
+                                  cwd=log_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(0.3)
+    router_addr = ('localhost', args.router_port)
+
+    try:
+        data = os.urandom(args.bytes)
+        print("%-6s %6s %8s %10s %12s %10s" % ("cc", "mss", "packets", "seconds", "KB/s", "received"))
+        for name in args.congestion:
+            for mss in args.mss:
+                if name == FixedWindow.name:
+                    congestion = FixedWindow(args.fixed_window)
+                else:
+                    congestion = CONGESTION_CONTROLS[name]()
+                elapsed, received = run(router_addr, args.port, data, mss, congestion, args.recv_window,
+                                        args.max_packet_len, args.idle_timeout)
+                print("%-6s %6d %8d %10.2f %12.1f %10s" % (name, mss, -(-len(data) // mss), elapsed,
+                                                           len(data) / elapsed / 1e3,
+                                                           "ok" if received == len(data) else received))
+    finally:
+        if router is not None:
+            router.terminate()
+            router.wait()
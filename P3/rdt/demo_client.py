@@ -9,7 +9,7 @@ router_addr = ('localhost', 3000)
 # client initiate connection
 peer_ip = ipaddress.ip_address(socket.gethostbyname(server_addr))
 
-rdt_conn = ReliableDT(router_addr)
+rdt_conn = ReliableDT(router_addr, verbose=True)
 rdt_conn.connect((peer_ip, server_port))
 
 data = bytearray()
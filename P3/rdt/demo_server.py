@@ -14,7 +14,7 @@ server_addr = 'localhost'
 server_port = 8007
 router_addr = ('localhost', 3000)
 
-conn = ReliableDT(router_addr)
+conn = ReliableDT(router_addr, verbose=True)
 
 try:
     conn.bind((server_addr, server_port))
@@ -1,9 +1,9 @@
+import heapq
 import socket
 import ipaddress
 import random
-import threading
+import selectors
 import time
-from datetime import datetime
 
 from P3.example.python.packet import Packet
 
@@ -20,27 +20,32 @@ class ConnectionState:
 
 
 class MyPacket:
-    MIN_LEN = 15
-    MAX_LEN = 1024
+    MIN_LEN = 17
+    MAX_LEN = 1024       # largest packet the router forwards
+    MAX_UDP_LEN = 65507  # largest packet size that can be negotiated, with a router that allows it
+    MAX_WINDOW = 0xffff  # largest advertised window, it is sent in 2 bytes
 
-    def __init__(self, packet_type, seq_num, peer_ip_addr, peer_port, ack_num, payload: bytes):
+    def __init__(self, packet_type, seq_num, peer_ip_addr, peer_port, ack_num, payload: bytes, window=0):
         """
-        Wrap the Packet class, add ack_num into the packet
+        Wrap the Packet class, add ack_num and the receiver-advertised window into the packet
         :param packet_type:
         :param seq_num:
         :param peer_ip_addr:
         :param peer_port:
         :param ack_num:
         :param payload: should be bytes
+        :param window: number of packets from its recv_base the sender of this packet can buffer
         """
         self.packet_type = int(packet_type)
         self.seq_num = int(seq_num)
         self.peer_ip_addr = peer_ip_addr
         self.peer_port = int(peer_port)
         self.ack_num = int(ack_num)
+        self.window = int(window)
         self.payload = payload
 
-        payload_to_router = self.ack_num.to_bytes(4, byteorder='big') + payload
+        payload_to_router = self.ack_num.to_bytes(4, byteorder='big') + self.window.to_bytes(2, byteorder='big') \
+            + payload
         self.packet_to_router = Packet(packet_type=self.packet_type,
                                        seq_num=self.seq_num,
                                        peer_ip_addr=self.peer_ip_addr,
@@ -55,19 +60,20 @@ class MyPacket:
         return self.packet_to_router.to_bytes()
 
     def __repr__(self, *args, **kwargs):
-        return "#%d, #%d, peer=%s:%s, size=%d" % \
-               (self.seq_num, self.ack_num, self.peer_ip_addr, self.peer_port, len(self.payload))
+        return "#%d, #%d, peer=%s:%s, window=%d, size=%d" % \
+               (self.seq_num, self.ack_num, self.peer_ip_addr, self.peer_port, self.window, len(self.payload))
 
     @staticmethod
-    def from_bytes(raw):
+    def from_bytes(raw, max_len=MAX_LEN):
         """
         From raw bytes creates a MyPacket instance
         :param raw:
+        :param max_len: max packet size of the connection
         :return:
         """
         if len(raw) < MyPacket.MIN_LEN:
             raise ValueError("Packet is too short: {} bytes".format(len(raw)))
-        if len(raw) > MyPacket.MAX_LEN:
+        if len(raw) > max_len:
             raise ValueError("Packet is exceeded max length: {} bytes".format(len(raw)))
 
         curr = [0, 0]
@@ -81,6 +87,7 @@ class MyPacket:
         peer_addr = ipaddress.ip_address(nbytes(4))
         peer_port = int.from_bytes(nbytes(2), byteorder='big')
         ack_num = int.from_bytes(nbytes(4), byteorder='big')
+        window = int.from_bytes(nbytes(2), byteorder='big')
         payload = raw[curr[1]:]
 
         return MyPacket(packet_type=packet_type,
@@ -88,34 +95,219 @@ class MyPacket:
                         peer_ip_addr=peer_addr,
                         peer_port=peer_port,
                         ack_num=ack_num,
-                        payload=payload)
+                        payload=payload,
+                        window=window)
+
+
+class RetransmissionTimers:
+    """
+    Retransmission timers of the packets in flight, as a min-heap of (deadline, seq num) on the monotonic clock.
+    A cancelled or restarted timer stays in the heap and is dropped when it reaches the top,
+    so starting, cancelling and expiring a timer are O(log n) whatever the window size.
+    """
+    def __init__(self):
+        self.heap = []
+        self.deadlines = dict()  # seq num -> deadline of its running timer
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, seq_num):
+        return seq_num in self.deadlines
+
+    def start(self, seq_num, timeout):
+        """
+        Start, or restart, the timer of seq_num to expire in timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        self.deadlines[seq_num] = deadline
+        heapq.heappush(self.heap, (deadline, seq_num))
+        # rebuild the heap once stale entries outnumber running timers, to bound its memory
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(d, s) for s, d in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def cancel(self, seq_num):
+        self.deadlines.pop(seq_num, None)
+
+    def drop_stale(self):
+        heap = self.heap
+        while heap and self.deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next_deadline(self):
+        """
+        :return: time.monotonic() when the earliest timer expires, None if no timer is running
+        """
+        self.drop_stale()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now):
+        """
+        Stop and return the seq nums whose timers have expired at now, earliest first
+        """
+        expired = []
+        self.drop_stale()
+        while self.heap and self.heap[0][0] <= now:
+            _, seq_num = heapq.heappop(self.heap)
+            del self.deadlines[seq_num]
+            expired.append(seq_num)
+            self.drop_stale()
+        return expired
+
+
+class RtoEstimator:
+    """
+    Retransmission timeout computed from round-trip time samples as in RFC 6298.
+    Samples must only come from packets that were not retransmitted (Karn's algorithm),
+    the timeout is doubled on every retransmission timeout until the next sample.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto=1.0, min_rto=0.05, max_rto=60.0, granularity=0.001):
+        """
+        :param min_rto: lower clamp in seconds. RFC 6298 recommends 1s, partly to cover delayed ACKs,
+                        our receiver ACKs every packet at once and a local router has RTTs of a few ms
+        :param max_rto: upper clamp in seconds
+        :param granularity: clock granularity in seconds
+        """
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.granularity = granularity
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.clamp(initial_rto)
+
+    def clamp(self, rto):
+        return min(max(rto, self.min_rto), self.max_rto)
+
+    def on_sample(self, rtt):
+        """
+        :param rtt: seconds between sending a packet once and receiving its ACK
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = self.clamp(self.srtt + max(self.granularity, self.K * self.rttvar))
+
+    def backoff(self):
+        self.rto = self.clamp(self.rto * 2)
+
+
+class FixedWindow:
+    """
+    Congestion control that is not: a constant number of packets in flight, the old fixed sliding window
+    """
+    name = 'fixed'
+
+    def __init__(self, size=8):
+        self.cwnd = size
+
+    def window(self):
+        return int(self.cwnd)
+
+    def on_ack(self):
+        pass
+
+    def on_loss(self, in_flight):
+        pass
+
+    def on_timeout(self, in_flight):
+        pass
+
+
+class Reno(FixedWindow):
+    """
+    TCP Reno congestion window in packets (RFC 5681): slow start up to ssthresh, then additive increase
+    of one packet per window of ACKs. A loss found from selective ACKs halves the window (fast recovery),
+    a retransmission timeout falls back to one packet and slow start.
+    """
+    name = 'reno'
+
+    def __init__(self, initial_window=4, ssthresh=65535):
+        super().__init__(initial_window)
+        self.ssthresh = ssthresh
+
+    def on_ack(self):
+        """
+        A packet sent outside of recovery has been acknowledged
+        """
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+        else:
+            self.cwnd += 1 / self.cwnd
+
+    def on_loss(self, in_flight):
+        """
+        Start of fast recovery, called once per window of data with losses
+        :param in_flight: packets sent and not cumulatively acked yet
+        """
+        self.ssthresh = max(in_flight / 2, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, in_flight):
+        self.ssthresh = max(in_flight / 2, 2)
+        self.cwnd = 1
+
+
+CONGESTION_CONTROLS = {FixedWindow.name: FixedWindow, Reno.name: Reno}
 
 
 class ReliableDT:
-    def __init__(self, router_addr):
+    def __init__(self, router_addr, verbose=False, max_packet_len=MyPacket.MAX_LEN, mss=None, congestion=None,
+                 recv_window=1024):
+        """
+        :param max_packet_len: largest packet, header included, this side sends or accepts. The smaller
+                               max_packet_len of both sides is agreed on in the SYN/SYN_ACK handshake
+        :param mss: max payload bytes per packet, None to fill the agreed max packet size
+        :param congestion: congestion control of the sender, e.g. Reno() (the default) or FixedWindow(8)
+        :param recv_window: number of packets past recv_base this side buffers, advertised to the peer
+        """
+        if not MyPacket.MIN_LEN < max_packet_len <= MyPacket.MAX_UDP_LEN:
+            raise ValueError("max_packet_len must be in ({}, {}]".format(MyPacket.MIN_LEN, MyPacket.MAX_UDP_LEN))
+        if not 0 < recv_window <= MyPacket.MAX_WINDOW:
+            raise ValueError("recv_window must be in (0, {}]".format(MyPacket.MAX_WINDOW))
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.router_addr = router_addr
+        self.verbose = verbose   # print every packet sent and received
 
-        self.max_chunk_len = 2
-        self.is_sending = False
+        self.max_packet_len = max_packet_len
+        self.mss = mss
+        self.max_chunk_len = self.chunk_len_for(max_packet_len)
 
         # for sender side
         self.peer_addr_of_sender = None
 
-        self.timeout = 2
+        self.timeout = 2         # recvall returns after 3 timeouts in a row without packets
+        self.rto = RtoEstimator()  # retransmission timeout of the handshake and of data packets
 
-        self.wsz = 8             # sliding window size
-        self.send_buffer = None  # sender buffer[wsz], allocate in runtime
-        self.timers = None       # timers[wsz], timer for each packet in sliding window
-        self.acks = None         # acks[wsz], received acks in sliding window
+        self.congestion = congestion or Reno()  # limits the number of packets in flight
+        self.peer_window = 8     # window advertised by the peer, updated from every packet it sends
+        self.dupthresh = 3       # a packet is lost once this many packets sent after it are acked
+        self.reorder_window = 1 / 4  # ... and it has been in flight for srtt plus this fraction of srtt
+        self.send_buffer = None  # seq num -> packet sent and not acked yet, allocate in runtime
+        self.timers = None       # RetransmissionTimers of the packets in flight
+        self.sent_times = None   # seq num -> time.monotonic() a packet was sent, until it is acked or resent
         self.send_base = None
+        self.next_seq_num = None  # seq num of the next new packet, packets from send_base up to it are in flight
+        self.top_acked = None     # min-heap of the dupthresh highest acked seq nums
+        self.loss_scan = None     # packets below it have been checked for loss
+        self.lost = None          # seq nums of packets taken as lost and waiting for the window to be resent
+        self.lost_heap = None     # min-heap of the same seq nums, may contain ones already resent or acked
+        self.recovery_point = None  # fast recovery ends once every packet up to it is acked, None if not in recovery
 
         self._ack_number = None  # used to store last ack number sent by sender in 3-way handshake
         self._seq_number = None  # used to store last seq number sent by sender in 3-way handshake
 
         # for receiver side
+        self.recv_window = recv_window
         self.peer_addr_of_receiver = None
-        self.recv_buffer = None
+        self.recv_buffer = None  # seq num -> payload received out of order
         self.recv_base = None
         self.bytearray_to_be_delivered = None  # data can already be delivered
         self.recv_resources_allocated = False
@@ -124,13 +316,36 @@ class ReliableDT:
     def bind(self, addr):
         self.conn.bind(addr)
 
+    def chunk_len_for(self, max_packet_len):
+        """
+        Payload bytes per packet for a max packet size: the configured mss, at most what fits in a packet
+        """
+        max_payload = max_packet_len - MyPacket.MIN_LEN
+        return max_payload if self.mss is None else max(1, min(self.mss, max_payload))
+
+    def set_max_packet_len(self, max_packet_len):
+        """
+        Use the max packet size agreed on in the handshake
+        """
+        self.max_packet_len = max_packet_len
+        self.max_chunk_len = self.chunk_len_for(max_packet_len)
+        print("Max packet size is %d, %d bytes of payload per packet" % (max_packet_len, self.max_chunk_len))
+
+    def recv_packet(self):
+        """
+        Receive and parse one packet
+        :raise ValueError: if the packet is malformed or larger than the max packet size
+        """
+        data, sender = self.conn.recvfrom(MyPacket.MAX_UDP_LEN)
+        return MyPacket.from_bytes(data, self.max_packet_len)
+
     def connect(self, addr):
         """
         Sender side three-way handshake connection to addr
         :param addr: destination address
         :return:
         """
-        # send SYN message with seq=client_isn
+        # send SYN message with seq=client_isn, proposing our max packet size
         # client_isn = random.randint(0, 999)
         client_isn = 99
         syn_packet = MyPacket(packet_type=PacketType.SYN,
@@ -138,28 +353,45 @@ class ReliableDT:
                               peer_ip_addr=addr[0],
                               peer_port=addr[1],
                               ack_num=0,
-                              payload="".encode("utf-8"))
+                              payload=self.max_packet_len.to_bytes(2, byteorder='big'),
+                              window=self.recv_window)
 
+        attempts = 0
         while True:
             try:
+                sent_time = time.monotonic()
                 self.conn.sendto(syn_packet.to_bytes(), self.router_addr)
+                attempts += 1
 
-                self.conn.settimeout(self.timeout)
+                self.conn.settimeout(self.rto.rto)
 
                 # after sending SYN, waiting fro SYN_ACK response
                 print("In connect(), waiting for a SYN_ACK response")
-                response, sender = self.conn.recvfrom(1024)
-                response_packet = MyPacket.from_bytes(response)
+                try:
+                    response_packet = self.recv_packet()
+                except ValueError:
+                    continue
                 if response_packet.packet_type != PacketType.SYN_ACK:
                     continue
                 if response_packet.ack_num != client_isn + 1:
                     continue
 
                 server_isn = response_packet.seq_num
+                self.peer_window = response_packet.window
+                # the SYN_ACK carries the agreed max packet size, a peer without negotiation sends none
+                if len(response_packet.payload) >= 2:
+                    agreed = int.from_bytes(response_packet.payload[:2], byteorder='big')
+                else:
+                    agreed = MyPacket.MAX_LEN
+                self.set_max_packet_len(min(agreed, self.max_packet_len))
+                # Karn's algorithm: the SYN_ACK of a resent SYN could answer any of the copies
+                if attempts == 1:
+                    self.rto.on_sample(time.monotonic() - sent_time)
                 break
 
             except socket.timeout:
                 # if timeout occurs, resend SYN
+                self.rto.backoff()
                 continue
 
         # received response correctly, send ACK
@@ -168,7 +400,8 @@ class ReliableDT:
                               peer_ip_addr=addr[0],
                               peer_port=addr[1],
                               ack_num=server_isn + 1,
-                              payload="".encode("utf-8"))
+                              payload="".encode("utf-8"),
+                              window=self.recv_window)
 
         self.conn.sendto(ack_packet.to_bytes(), self.router_addr)
         # self._ack_number = server_isn + 1
@@ -183,23 +416,30 @@ class ReliableDT:
         # todo: corrected, no need to resend, the following data packet will have ACK anyway
 
     def accept(self):
-        data, sender = None, None
+        p = None
         while True:
             try:
-                data, sender = self.conn.recvfrom(1024)
-                if sender or data:
-                    break
+                p = self.recv_packet()
+                break
             except socket.timeout:
                 continue
-
-        p = MyPacket.from_bytes(data)
+            except ValueError:
+                continue
 
         # received SYN, send SYN_ACK back
         if p.packet_type == PacketType.SYN:
             server_isn = 999
 
+            # agree on the smaller max packet size, a peer without negotiation sends none
+            if len(p.payload) >= 2:
+                proposed = int.from_bytes(p.payload[:2], byteorder='big')
+            else:
+                proposed = MyPacket.MAX_LEN
+            self.set_max_packet_len(max(MyPacket.MIN_LEN + 1, min(proposed, self.max_packet_len)))
+
             ack_id = p.seq_num + 1
             self.recv_base = ack_id
+            self.peer_window = p.window
             self.send_base = server_isn + 1
 
             addr = (p.peer_ip_addr, p.peer_port)
@@ -210,91 +450,251 @@ class ReliableDT:
                                       peer_ip_addr=addr[0],
                                       peer_port=addr[1],
                                       ack_num=ack_id,
-                                      payload="".encode('utf-8'))
+                                      payload=self.max_packet_len.to_bytes(2, byteorder='big'),
+                                      window=self.recv_window)
 
+            attempts = 0
             while True:
                 try:
+                    sent_time = time.monotonic()
                     self.conn.sendto(syn_ack_packet.to_bytes(), self.router_addr)
+                    attempts += 1
 
-                    self.conn.settimeout(self.timeout)
+                    self.conn.settimeout(self.rto.rto)
 
                     # after sending SYN_ACK, waiting for ACK response
                     print("In accept(), waiting for ACK response from sender")
-                    response, sender = self.conn.recvfrom(1024)
-                    response_packet = MyPacket.from_bytes(response)
+                    try:
+                        response_packet = self.recv_packet()
+                    except ValueError:
+                        continue
                     if response_packet.packet_type != PacketType.ACK:
                         continue
                     if response_packet.ack_num != server_isn + 1:
                         continue
                     print("Server state -> ESTABLISHED")
+                    if attempts == 1:
+                        self.rto.on_sample(time.monotonic() - sent_time)
 
                     # allocate resources for receiver
                     self.allocate_receiver_resources(response_packet)
                     return self
 
                 except socket.timeout:
+                    self.rto.backoff()
                     continue
 
 
     def sendall(self, data:bytes):
+        """
+        Send data with selective repeat, return once every packet has been acknowledged.
+        One loop fills the window, then blocks on the socket until an ACK arrives or the earliest
+        timer expires, so no CPU is used while waiting and no other thread touches the window.
+        The packets in flight are limited by the congestion window, and the span from send_base
+        by the window the receiver advertises. Lost packets are resent before new ones, as the
+        congestion window lets them, only the first of a loss episode is resent at once.
+        """
         # split data into chunks
         data_len, chunk_size = len(data), self.max_chunk_len
         chunks = [data[i:i+chunk_size] for i in range(0, data_len, chunk_size)]
-        print(chunks)
-
-        self.is_sending = True
-
-        self.send_buffer = [None] * self.wsz
-        self.timers = [None] * self.wsz
-        self.acks = [False] * self.wsz
+        if self.verbose:
+            print(chunks)
+
+        self.send_buffer = dict()
+        self.timers = RetransmissionTimers()
+        self.sent_times = dict()
+        self.top_acked = []
+        self.loss_scan = self.send_base
+        self.lost = set()
+        self.lost_heap = []
+        self.recovery_point = None
 
         initial_seq_num = self.send_base
+        self.next_seq_num = self.send_base
         print("send_base is : " + str(self.send_base))
         end_seq_num = self.send_base + len(chunks)
         print("end of send base is : " + str(end_seq_num))
 
-        # create a thread to monitor timers
-        threading.Thread(target=self.timer_monitor, args=(end_seq_num, )).start()
+        selector = selectors.DefaultSelector()
+        selector.register(self.conn, selectors.EVENT_READ)
+        try:
+            while self.send_base < end_seq_num:
+                # resend lost packets, then send every chunk that fits in the congestion window
+                # and the receiver's window; lost packets are not in flight any more
+                while len(self.send_buffer) - len(self.lost) < self.congestion.window():
+                    if self.lost:
+                        seq_num = heapq.heappop(self.lost_heap)
+                        if seq_num in self.lost:
+                            self.lost.remove(seq_num)
+                            self.resend(seq_num, "Resend lost")
+                        continue
+                    if self.next_seq_num >= end_seq_num or self.next_seq_num >= self.send_base + self.peer_window:
+                        break
+                    seq_num = self.next_seq_num
+                    packet = MyPacket(packet_type=PacketType.ACK,
+                                      seq_num=seq_num,
+                                      peer_ip_addr=self.peer_addr_of_sender[0],
+                                      peer_port=self.peer_addr_of_sender[1],
+                                      ack_num=self.recv_base,
+                                      payload=chunks[seq_num - initial_seq_num],
+                                      window=self.recv_window)
+                    self.send_buffer[seq_num] = packet
+                    self.sent_times[seq_num] = time.monotonic()
+                    self.timers.start(seq_num, self.rto.rto)
+                    self.conn.sendto(packet.to_bytes(), self.router_addr)
+                    if self.verbose:
+                        print(packet)
+                    self.next_seq_num += 1
+
+                # wait for ACKs until the earliest timer expires, then handle every ACK already queued
+                deadline = self.timers.next_deadline()
+                events = selector.select(None if deadline is None else max(0.0, deadline - time.monotonic()))
+                while events:
+                    try:
+                        self.ack_received(self.recv_packet())
+                    except ValueError:
+                        pass
+                    events = selector.select(0)
+
+                self.detect_lost()
+                self.check_timers()
+        finally:
+            selector.close()
+        print("finish sending")
+
 
-        # create a thread to monitor received acks
-        threading.Thread(target=self.ack_monitor_sender, args=(end_seq_num, )).start()
+    def ack_received(self, packet):
+        """
+        Mark the packet acknowledged by a selective ACK, and slide the window past acknowledged packets
+        """
+        # SYN_ACKs resent by the peer and data packets carry an ack_num as well, only pure ACKs acknowledge data
+        if packet.packet_type != PacketType.ACK or packet.payload:
+            return
+        # never let a zero window stall the sender, there would be no ACK left to reopen it
+        self.peer_window = max(packet.window, 1)
+        ack_num = packet.ack_num
+        if ack_num not in self.send_buffer:
+            return
+        del self.send_buffer[ack_num]
+        self.lost.discard(ack_num)
+        self.timers.cancel(ack_num)
+        # Karn's algorithm: no RTT sample from a packet that was resent, the ACK could be for either copy
+        sent_time = self.sent_times.pop(ack_num, None)
+        if sent_time is not None:
+            self.rto.on_sample(time.monotonic() - sent_time)
+
+        # the window only grows with ACKs of packets sent outside of recovery
+        if self.recovery_point is None:
+            self.congestion.on_ack()
+        heapq.heappush(self.top_acked, ack_num)
+        if len(self.top_acked) > self.dupthresh:
+            heapq.heappop(self.top_acked)
+
+        # slide window to the unacknowledged packet with smallest seq num
+        if ack_num == self.send_base:
+            while self.send_base < self.next_seq_num and self.send_base not in self.send_buffer:
+                self.send_base += 1
+            if self.verbose:
+                print("After sliding window, sendbase = " + str(self.send_base))
+            if self.recovery_point is not None and self.send_base > self.recovery_point:
+                self.recovery_point = None
+
+
+    def detect_lost(self):
+        """
+        Fast retransmit: a packet not acked while dupthresh packets sent after it are is taken as lost
+        instead of waiting for its timer. The congestion window is reduced once per window of data,
+        when fast recovery starts.
+        """
+        if len(self.top_acked) < self.dupthresh or self.rto.srtt is None:
+            return
+        # every unacked packet below the dupthresh-th highest acked one has dupthresh acked packets above it
+        threshold = self.top_acked[0]
+        # the router delays each packet at random, so packets are reordered as well as lost. Also wait
+        # until a packet has been in flight a little longer than a round trip, as in RACK (RFC 8985)
+        sent_before = time.monotonic() - self.rto.srtt * (1 + self.reorder_window)
+        self.loss_scan = max(self.loss_scan, self.send_base)
+        while self.loss_scan < threshold:
+            seq_num = self.loss_scan
+            # packets already resent are left to their timer
+            if seq_num in self.sent_times:
+                if self.sent_times[seq_num] > sent_before:
+                    # sent in seq num order, later packets are too recent as well
+                    break
+                self.packet_lost(seq_num, "Fast retransmit")
+            self.loss_scan += 1
 
-        # send each chunk
-        for i, chunk in enumerate(chunks):
-            while self.is_full(self.send_buffer):
-                pass
 
-            seq_num = initial_seq_num + i
-            packet = MyPacket(packet_type=PacketType.ACK,
-                              seq_num=seq_num,
-                              peer_ip_addr=self.peer_addr_of_sender[0],
-                              peer_port=self.peer_addr_of_sender[1],
-                              ack_num=self.recv_base,
-                              payload=chunk)
+    def packet_lost(self, seq_num, reason):
+        """
+        The first loss outside of recovery starts fast recovery and is resent at once,
+        the others wait in self.lost for the congestion window
+        """
+        if self.recovery_point is None:
+            self.recovery_point = self.next_seq_num - 1
+            self.congestion.on_loss(self.next_seq_num - self.send_base)
+            self.resend(seq_num, reason)
+            return
+        self.mark_lost(seq_num)
+
+
+    def mark_lost(self, seq_num):
+        if seq_num in self.lost:
+            return
+        self.timers.cancel(seq_num)
+        self.sent_times.pop(seq_num, None)
+        self.lost.add(seq_num)
+        heapq.heappush(self.lost_heap, seq_num)
 
-            buffer_index = seq_num - self.send_base
-            self.send_buffer[buffer_index] = packet
-            self.timers[buffer_index] = datetime.now()
-            self.conn.sendto(packet.to_bytes(), self.router_addr)
-            print(packet)
 
+    def check_timers(self):
+        """
+        Handle expired timers. Like the single timer of TCP, a retransmission timeout is when the oldest
+        packet in flight times out: the timeout is backed off, the congestion window collapsed, only that
+        packet is resent at once and every other packet in flight is taken as lost, to be resent as slow
+        start opens the window again (RFC 5681 and RFC 6675). Another packet timing out is a loss.
+        """
+        expired = self.timers.pop_expired(time.monotonic())
+        if self.send_base not in expired:
+            for seq_num in expired:
+                self.packet_lost(seq_num, "Resend")
+            return
+        self.rto.backoff()
+        self.congestion.on_timeout(self.next_seq_num - self.send_base)
+        self.recovery_point = None
+        for seq_num in self.send_buffer:
+            if seq_num != self.send_base:
+                self.mark_lost(seq_num)
+        self.resend(self.send_base, "Timeout, resend")
+
+
+    def resend(self, seq_num, reason):
+        self.sent_times.pop(seq_num, None)
+        if self.verbose:
+            print("%s packet # %d, rto %.3fs, cwnd %d" % (reason, seq_num, self.rto.rto, self.congestion.window()))
+        try:
+            self.conn.sendto(self.send_buffer[seq_num].to_bytes(), self.router_addr)
+        except OSError:
+            pass
+        self.timers.start(seq_num, self.rto.rto)
 
 
     # return all data
     def recvall(self):
-        while self.is_sending:
-            pass
+        self.conn.settimeout(self.timeout)
 
         # if timeout_count > 5, meaning that sender finished sending
         max_timeout_count = 3
         timeout_count = 0
         while True:
-            data, sender = None, None
+            packet = None
             try:
-                data, sender = self.conn.recvfrom(1024)
+                packet = self.recv_packet()
             except socket.timeout:
                 timeout_count += 1
-            if data is None or sender is None:
+            except ValueError:
+                continue
+            if packet is None:
                 if not self.recv_resources_allocated:
                     print(self.recv_resources_allocated)
                     continue
@@ -305,15 +705,22 @@ class ReliableDT:
                     break
 
             timeout_count = 0
-            packet = MyPacket.from_bytes(data)
+
+            # pure ACKs carry no data: ACKs of our own last packets can still arrive after sendall returned,
+            # and the handshake ACK has the seq num of the first data packet and can arrive after it.
+            # Resent SYNs and SYN_ACKs carry the max packet size, not data
+            if packet.packet_type != PacketType.ACK or not packet.payload:
+                continue
 
             # if allocate_receiver_resources not have been called
             if not self.recv_resources_allocated:
                 self.allocate_receiver_resources(packet)
 
-            print(packet.payload)
+            if self.verbose:
+                print(packet.payload)
             self.receiver_actions(packet)
-            print(self.bytearray_to_be_delivered)
+            if self.verbose:
+                print(self.bytearray_to_be_delivered)
             # if len(packet.payload) < self.max_chunk_len:
             #     break
 
@@ -328,139 +735,54 @@ class ReliableDT:
         print("recv base is: " + str(self.recv_base))
 
         self.peer_addr_of_receiver = (first_packet.peer_ip_addr, first_packet.peer_port)
-        self.recv_buffer = [None] * self.wsz
+        self.recv_buffer = dict()
         self.bytearray_to_be_delivered = bytearray()
         self.recv_resources_allocated = True
 
         # if first_packet contains payload, must response to sender
         if first_packet.payload:
-            print("First packet contains payload is: ")
-            print(first_packet.payload)
+            if self.verbose:
+                print("First packet contains payload is: ")
+                print(first_packet.payload)
             self.receiver_actions(first_packet)
         return
 
 
     def receiver_actions(self, packet_recved:MyPacket):
         seq_num = packet_recved.seq_num
-        if self.recv_base <= seq_num <= self.recv_base + self.wsz - 1:
+        if self.recv_base <= seq_num < self.recv_base + self.recv_window:
             # return a selective ACK packet
-            ack_packet = MyPacket(packet_type=PacketType.ACK,
-                                  seq_num=seq_num,
-                                  peer_ip_addr=self.peer_addr_of_receiver[0],
-                                  peer_port=self.peer_addr_of_receiver[1],
-                                  ack_num=seq_num,
-                                  payload="".encode('utf-8'))
-            self.conn.sendto(ack_packet.to_bytes(), self.router_addr)
+            self.send_ack(seq_num)
 
             # if not previously received, buffer it
-            buffer_index = seq_num - self.recv_base
-            if self.recv_buffer[buffer_index] is None:
-                self.recv_buffer[buffer_index] = packet_recved.payload
+            if seq_num not in self.recv_buffer:
+                self.recv_buffer[seq_num] = packet_recved.payload
 
             # slide window, and delivered buffered consecutive blocks
             if seq_num == self.recv_base:
-                num_slide = self.num_consecutive_buffers(self.recv_buffer)
-                print("Slide recv buffer window by " + str(num_slide))
-
-                # deliver to upper layer
-                for i in range(num_slide):
-                    self.bytearray_to_be_delivered.extend(bytearray(self.recv_buffer[i]))
-
-                # slide window
-                for j in range(num_slide):
-                    self.recv_buffer.pop(0)
-                    self.recv_buffer.append(None)
+                num_slide = 0
+                while self.recv_base in self.recv_buffer:
+                    # deliver to upper layer
+                    self.bytearray_to_be_delivered.extend(self.recv_buffer.pop(self.recv_base))
                     self.recv_base += 1
+                    num_slide += 1
+                if self.verbose:
+                    print("Slide recv buffer window by " + str(num_slide))
 
-        elif self.recv_base-self.wsz <= seq_num <= self.recv_base-1:
-            # return a selective ACK packet
-            ack_packet = MyPacket(packet_type=PacketType.ACK,
-                                  seq_num=seq_num,
-                                  peer_ip_addr=self.peer_addr_of_receiver[0],
-                                  peer_port=self.peer_addr_of_receiver[1],
-                                  ack_num=seq_num,
-                                  payload="".encode('utf-8'))
-            self.conn.sendto(ack_packet.to_bytes(), self.router_addr)
-
-
-    def timer_monitor(self, end_seq_num):
-        while self.send_base < end_seq_num:
-            for i in range(self.wsz):
-                timer = self.timers[i]
-                if timer and (datetime.now() - timer).total_seconds() > self.timeout:
-                    # trigger timeout event
-                    seq_num = i + self.send_base
-                    packet = self.send_buffer[i]
-                    if packet and seq_num != packet.seq_num:
-                        print("Error, seq_num != packet.seq_num when timeout occurs")
-                    else:
-                        print("Resend packet # " + str(seq_num))
-                        try:
-                            self.conn.sendto(packet.to_bytes(), self.router_addr)  # resend packet
-                        except Exception:
-                            pass
-                        self.timers[i] = datetime.now()   # reset timer
-
-
-    def ack_monitor_sender(self, end_seq_num):
-        data, sender = None, None
-        while self.send_base < end_seq_num:
-            try:
-                data, sender = self.conn.recvfrom(1024)
-            except socket.timeout:
-                pass
-            if data is None or sender is None:
-                continue
-
-            # received ack, trigger ack_received event
-            packet = MyPacket.from_bytes(data)
-            ack_num = packet.ack_num
-
-            if self.send_base <= ack_num < self.send_base + self.wsz:
-                acks_index = ack_num - self.send_base
-                self.acks[acks_index] = True
-                self.timers[acks_index] = None
-
-                # slide window to the unacknowledged packet with smallest seq num
-                if ack_num == self.send_base:
-                    num_slided = self.num_consecutive_acks(self.acks)
-                    print("Slide send buffer window by " + str(num_slided))
-
-                    # slide window
-                    for k in range(num_slided):
-                        self.send_buffer.pop(0)
-                        self.timers.pop(0)
-                        self.acks.pop(0)
-                        self.send_buffer.append(None)
-                        self.timers.append(None)
-                        self.acks.append(False)
-                        self.send_base += 1
-                    print("After sliding window, sendbase = " + str(self.send_base))
-        time.sleep(self.timeout)
-        self.is_sending = False
-        print("finish sending")
-
-
-    def is_full(self, array):
-        return array.count(None) == 0
-
-
-    def num_consecutive_buffers(self, array):
-        n = self.wsz
-        for i in range(self.wsz):
-            if array[i] is None:
-                n = i
-                break
-        return n
-
-    def num_consecutive_acks(self, array):
-        n = self.wsz
-        for i in range(self.wsz):
-            if array[i] is False:
-                n = i
-                break
-        return n
-
-
+        elif self.recv_base - self.recv_window <= seq_num <= self.recv_base - 1:
+            # already delivered, the ACK was lost: acknowledge it again
+            self.send_ack(seq_num)
 
 
+    def send_ack(self, seq_num):
+        """
+        Send a selective ACK of seq_num, advertising the receive window
+        """
+        ack_packet = MyPacket(packet_type=PacketType.ACK,
+                              seq_num=seq_num,
+                              peer_ip_addr=self.peer_addr_of_receiver[0],
+                              peer_port=self.peer_addr_of_receiver[1],
+                              ack_num=seq_num,
+                              payload="".encode('utf-8'),
+                              window=self.recv_window)
+        self.conn.sendto(ack_packet.to_bytes(), self.router_addr)
@@ -0,0 +1,44 @@
+import argparse
+import os
+import time
+
+from httpfs import HttpFs
+
+
+def measure(content, encoding, level, rounds):
+    """
+    :return: (compressed size, seconds of CPU per compression)
+    """
+    start = time.process_time()
+    for _ in range(rounds):
+        data = HttpFs.compress(content, encoding, level)
+    return len(data), (time.process_time() - start) / rounds
+
+
+# Usage: python bench_gzip.py [-d FileServer/] [--levels 1 6 9] [--rounds 20]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--directory", help="directory of files to compress", default="FileServer/")
+    parser.add_argument("--levels", help="compression levels", type=int, nargs="+", default=[1, 6, 9])
+    parser.add_argument("--rounds", help="compressions per file and level", type=int, default=20)
+    args = parser.parse_args()
+
+    contents = []
+    for name in sorted(os.listdir(args.directory)):
+        path = os.path.join(args.directory, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                contents.append(f.read())
+    total = sum(len(c) for c in contents)
+    print("%d files, %d bytes" % (len(contents), total))
+
+    print("%-8s %5s %12s %8s %12s %14s" % ("encoding", "level", "bytes", "ratio", "saved", "CPU ms/MB"))
+    for encoding in ('gzip', 'deflate'):
+        for level in args.levels:
+            size, seconds = 0, 0.0
+            for content in contents:
+                n, t = measure(content, encoding, level, args.rounds)
+                size += n
+                seconds += t
+            print("%-8s %5d %12d %8.2f %12d %14.2f" % (encoding, level, size, total / max(size, 1), total - size,
+                                                      seconds * 1000 / max(total / 1e6, 1e-9)))
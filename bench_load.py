@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httplib
+
+
+OPERATIONS = ('get', 'post', 'append', 'list')
+
+
+def parse_mix(mix):
+    """
+    'get=70,post=10,append=10,list=10' -> {'get': 70, 'post': 10, 'append': 10, 'list': 10}
+    """
+    weights = dict()
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError("unknown operation %r, expected one of %s" % (name, OPERATIONS))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def make_files(directory, sizes, files_per_size):
+    """
+    Create the files read by GET requests
+    :return: list of (name, size)
+    """
+    files = []
+    for size in sizes:
+        for i in range(files_per_size):
+            name = 'load-%d-%d.txt' % (size, i)
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write((b'%d ' % i) * (size // len(b'%d ' % i)) + b'x' * (size % len(b'%d ' % i)))
+            files.append((name, size))
+    return files
+
+
+def start_server(port, directory, engine, workers, extra_args):
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'httpfs.py'),
+           '-p', str(port), '-d', directory, '--engine', engine, '--workers', str(workers)] + extra_args
+    server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("httpfs did not start: " + " ".join(cmd))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def histogram(sorted_values):
+    """
+    Latency histogram with power-of-two millisecond buckets
+    :return: list of (upper bound in ms, count)
+    """
+    buckets = []
+    bound = 0.125
+    i = 0
+    while i < len(sorted_values):
+        count = 0
+        while i < len(sorted_values) and sorted_values[i] * 1000 <= bound:
+            count += 1
+            i += 1
+        buckets.append((bound, count))
+        bound *= 2
+    return buckets
+
+
+class LoadGenerator:
+    """
+    Threads sending a weighted mix of requests to one server for a fixed duration,
+    each thread with keep-alive connections from a shared pool
+    """
+    def __init__(self, base_url, files, mix, concurrency, duration, post_size):
+        self.base_url = base_url
+        self.files = files
+        self.ops = list(mix)
+        self.weights = [mix[op] for op in self.ops]
+        self.concurrency = concurrency
+        self.duration = duration
+        self.post_body = 'p' * post_size
+        self.pool = httplib.ConnectionPool(max_per_host=concurrency)
+        self.lock = threading.Lock()
+        self.latencies = {op: [] for op in self.ops}  # seconds of successful requests
+        self.errors = {op: 0 for op in self.ops}
+        self.bytes_received = 0
+
+    def request(self, op, rng, worker):
+        if op == 'get':
+            name, _ = rng.choice(self.files)
+            return httplib.fetch('get', self.base_url + name, None, pool=self.pool)
+        if op == 'post':
+            # every worker overwrites its own file, so the size of what is written stays fixed
+            return httplib.fetch('post', self.base_url + 'load-post-%d.txt' % worker, None,
+                                 body=self.post_body, pool=self.pool)
+        if op == 'append':
+            # all workers append to a few shared files to exercise the per-path write lock
+            return httplib.fetch('post', self.base_url + 'load-append-%d.txt' % rng.randrange(4),
+                                 ['append:True'], body=self.post_body[:64], pool=self.pool)
+        return httplib.fetch('get', self.base_url + '?limit=100', None, pool=self.pool)
+
+    def worker(self, worker, deadline):
+        rng = random.Random(worker)
+        latencies = {op: [] for op in self.ops}
+        errors = {op: 0 for op in self.ops}
+        received = 0
+        while time.monotonic() < deadline:
+            op = rng.choices(self.ops, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                status, _, body = self.request(op, rng, worker)
+            except (OSError, ValueError):
+                errors[op] += 1
+                continue
+            if status >= 400:
+                errors[op] += 1
+            else:
+                latencies[op].append(time.perf_counter() - start)
+                received += len(body)
+        with self.lock:
+            for op in self.ops:
+                self.latencies[op].extend(latencies[op])
+                self.errors[op] += errors[op]
+            self.bytes_received += received
+
+    def run(self):
+        deadline = time.monotonic() + self.duration
+        threads = [threading.Thread(target=self.worker, args=(i, deadline)) for i in range(self.concurrency)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        self.pool.close()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        def summary(latencies, errors):
+            latencies = sorted(latencies)
+            total = len(latencies) + errors
+            return {'requests': total, 'errors': errors,
+                    'error_rate': errors / total if total else 0.0,
+                    'throughput': total / elapsed,
+                    'p50_ms': percentile(latencies, 50) * 1000,
+                    'p95_ms': percentile(latencies, 95) * 1000,
+                    'p99_ms': percentile(latencies, 99) * 1000,
+                    'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+                    'histogram_ms': histogram(latencies)}
+
+        result = summary([t for op in self.ops for t in self.latencies[op]], sum(self.errors.values()))
+        result['elapsed'] = elapsed
+        result['mb_per_sec'] = self.bytes_received / elapsed / 1e6
+        result['operations'] = {op: summary(self.latencies[op], self.errors[op]) for op in self.ops}
+        return result
+
+
+def print_result(name, result):
+    print("== %s: %d requests in %.1fs, %.1f req/s, %.2f MB/s received, %.2f%% errors"
+          % (name, result['requests'], result['elapsed'], result['throughput'], result['mb_per_sec'],
+             result['error_rate'] * 100))
+    print("%-8s %9s %8s %9s %9s %9s %9s" % ("op", "requests", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for op, s in sorted(result['operations'].items()):
+        print("%-8s %9d %8d %9.2f %9.2f %9.2f %9.2f"
+              % (op, s['requests'], s['errors'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms']))
+    print("latency histogram (ms):")
+    peak = max([count for _, count in result['histogram_ms']] or [1])
+    for bound, count in result['histogram_ms']:
+        print("  <= %9.3f %8d %s" % (bound, count, '#' * (40 * count // peak)))
+
+
+# Usage: python bench_load.py [--engines threaded asyncio pool] [-c 16] [--duration 10]
+#                             [--mix get=70,post=10,append=10,list=10] [--file-sizes 1024 65536 1048576]
+#                             [--json results.json] [--url localhost:8080/]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engines", help="httpfs engines to start and measure one after the other", nargs="+",
+                        choices=['threaded', 'asyncio', 'pool'], default=['threaded'])
+    parser.add_argument("--workers", help="httpfs worker processes", type=int, default=1)
+    parser.add_argument("--port", help="port of the started httpfs", type=int, default=8099)
+    parser.add_argument("--server-args", help="extra httpfs arguments, e.g. '--no-compress'", default="")
+    parser.add_argument("--url", help="measure an already running server instead of starting one; "
+                                      "its root must contain the files from --directory")
+    parser.add_argument("-d", "--directory", help="root of the started server, a temporary directory by default")
+    parser.add_argument("-c", "--concurrency", help="number of client threads", type=int, default=16)
+    parser.add_argument("--duration", help="seconds per engine", type=float, default=10)
+    parser.add_argument("--mix", help="weights of get, post, append and list requests", type=parse_mix,
+                        default=parse_mix('get=70,post=10,append=10,list=10'))
+    parser.add_argument("--file-sizes", help="sizes in bytes of the files read by GET", type=int, nargs="+",
+                        default=[1024, 65536, 1048576])
+    parser.add_argument("--files-per-size", type=int, default=4)
+    parser.add_argument("--post-size", help="bytes sent by each POST", type=int, default=4096)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp(prefix='httpfs-load-')
+    try:
+        files = make_files(directory, args.file_sizes, args.files_per_size)
+        results = dict()
+        for engine in ([None] if args.url else args.engines):
+            server = None
+            if args.url:
+                base_url = args.url if args.url.endswith('/') else args.url + '/'
+                name = base_url
+            else:
+                server = start_server(args.port, directory, engine, args.workers, args.server_args.split())
+                base_url = 'localhost:%d/' % args.port
+                name = engine
+            try:
+                generator = LoadGenerator(base_url, files, args.mix, args.concurrency, args.duration, args.post_size)
+                results[name] = generator.run()
+            finally:
+                if server is not None:
+                    server.terminate()
+                    server.wait()
+            print_result(name, results[name])
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'config': {k: v for k, v in vars(args).items()}, 'results': results}, f, indent=2)
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
@@ -0,0 +1,80 @@
+import argparse
+import time
+
+import utils
+from httpparser import parse_request_header
+
+
+REQUESTS = {
+    'httpc-get': b'GET /foo.txt HTTP/1.1\r\nHost: localhost:8080\r\nAccept-Encoding: gzip, deflate\r\n'
+                 b'Connection: keep-alive',
+    'browser-get': b'GET /index.txt?x=1 HTTP/1.1\r\nHost: localhost:8080\r\n'
+                   b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0\r\n'
+                   b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+                   b'Accept-Language: en-US,en;q=0.5\r\nAccept-Encoding: gzip, deflate, br\r\n'
+                   b'Connection: keep-alive\r\nUpgrade-Insecure-Requests: 1\r\nSec-Fetch-Dest: document\r\n'
+                   b'Sec-Fetch-Mode: navigate\r\nSec-Fetch-Site: none\r\nSec-Fetch-User: ?1\r\n'
+                   b'Cache-Control: max-age=0',
+    'post': b'POST /foo.txt HTTP/1.1\r\nHost: localhost:8080\r\nContent-Type: text/plain\r\n'
+            b'Content-Length: 1024\r\nappend: True\r\nConnection: keep-alive',
+    'conditional': b'GET /foo.txt HTTP/1.1\r\nHost: localhost:8080\r\nAccept-Encoding: gzip, deflate\r\n'
+                   b'If-None-Match: "2c3f41-400-17a0c6b2d8e"\r\n'
+                   b'If-Modified-Since: Sat, 17 Oct 2026 10:00:00 GMT\r\nConnection: keep-alive',
+    'range': b'GET /foo.txt HTTP/1.1\r\nHost: localhost:8080\r\nRange: bytes=0-1023,4096-\r\n'
+             b'If-Range: "2c3f41-400-17a0c6b2d8e"\r\nConnection: keep-alive',
+}
+
+# the header lookups HttpFs does for a GET of a file
+LOOKUPS = (b'connection', b'accept-encoding', b'if-none-match', b'if-modified-since', b'range')
+
+
+def legacy_parse(header_str):
+    """
+    The dict based parser HttpFs used before httpparser
+    """
+    header = dict()
+    lines = header_str.split(b'\r\n')
+    tmp = lines[0].split(b' ')
+    header[b'method'] = tmp[0]
+    header[b'path'] = tmp[1]
+    header[b'http_version'] = tmp[2]
+    header.update(utils.parse_str_list_to_dict(lines[1:]))
+    return header
+
+
+def legacy_lookup(header, name):
+    for k, v in header.items():
+        if k.lower() == name:
+            return v
+    return None
+
+
+def run_legacy(header_str, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        header = legacy_parse(header_str)
+        for name in LOOKUPS:
+            legacy_lookup(header, name)
+    return (time.perf_counter() - start) / rounds
+
+
+def run_new(header_str, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        header = parse_request_header(header_str)
+        for name in LOOKUPS:
+            header.get(name)
+    return (time.perf_counter() - start) / rounds
+
+
+# Usage: python bench_parser.py [--rounds 100000]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", help="parses per request", type=int, default=100000)
+    args = parser.parse_args()
+
+    print("%-12s %6s %12s %12s %8s" % ("request", "bytes", "legacy us", "new us", "speedup"))
+    for name, header_str in REQUESTS.items():
+        legacy = run_legacy(header_str, args.rounds)
+        new = run_new(header_str, args.rounds)
+        print("%-12s %6d %12.2f %12.2f %8.2f" % (name, len(header_str), legacy * 1e6, new * 1e6, legacy / new))
@@ -0,0 +1,47 @@
+import argparse
+import threading
+import time
+
+import httplib
+
+
+def run(url, num_requests, concurrency, pool):
+    """
+    Send num_requests GET requests to url from `concurrency` threads
+    :return: requests per second
+    """
+    counter = [num_requests]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if counter[0] == 0:
+                    return
+                counter[0] -= 1
+            httplib.send_request('get', url, None, verbose=False, pool=pool)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return num_requests / (time.perf_counter() - start)
+
+
+# Usage: python bench_pool.py [--url localhost:8080/file1.txt] [-n 2000] [-c 4]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="URL to GET", default="localhost:8080/file1.txt")
+    parser.add_argument("-n", "--requests", help="number of requests", type=int, default=2000)
+    parser.add_argument("-c", "--concurrency", help="number of client threads", type=int, default=4)
+    args = parser.parse_args()
+
+    no_pool = run(args.url, args.requests, args.concurrency, pool=None)
+    print("without pool: %.1f requests/sec" % no_pool)
+
+    pool = httplib.ConnectionPool(max_per_host=args.concurrency)
+    with_pool = run(args.url, args.requests, args.concurrency, pool=pool)
+    pool.close()
+    print("with pool:    %.1f requests/sec" % with_pool)
@@ -0,0 +1,93 @@
+import bisect
+import os
+import threading
+from contextlib import contextmanager
+
+
+class DirectoryIndex:
+    """
+    Sorted index of the names in a directory, built with os.scandir. It is rebuilt lazily when the
+    mtime of the directory shows a change made by somebody else. Changes of this server are made
+    inside changing() and new names recorded with add(), so they do not cost a rescan.
+    """
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.names = []       # sorted list of names in bytes
+        self.listing = None   # b"name\n" * len(names), built on first full listing
+        self.mtime = None     # st_mtime_ns of the directory when names was last in sync
+        self.lock = threading.Lock()
+
+        self.rebuilds = 0
+
+    @staticmethod
+    def is_temporary(name):
+        # temporary files of uploads in progress, see HttpFs.handle_post_request
+        return name.startswith(b'.') and name.endswith(b'.tmp')
+
+    def refresh(self):
+        # caller holds self.lock
+        mtime = os.stat(self.root_path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with os.scandir(self.root_path) as it:
+            self.names = sorted(e.name for e in it if not self.is_temporary(e.name))
+        self.listing = None
+        self.mtime = mtime
+        self.rebuilds += 1
+
+    @staticmethod
+    def prefix_upper_bound(prefix):
+        """
+        Smallest bytes greater than every name starting with prefix, None if there is none
+        """
+        prefix = prefix.rstrip(b'\xff')
+        if not prefix:
+            return None
+        return prefix[:-1] + bytes([prefix[-1] + 1])
+
+    @contextmanager
+    def changing(self, directory):
+        """
+        Wrap a change of this server to `directory`: creating, renaming or removing a file in it.
+        If the index was in sync with the indexed directory before the change, it is taken to be
+        in sync after it, names created by the change have to be recorded with add().
+        A change by somebody else in the meantime makes the mtime differ, and is found by a rescan.
+        """
+        if directory != self.root_path:
+            yield
+            return
+        before = os.stat(self.root_path).st_mtime_ns
+        yield
+        with self.lock:
+            if self.mtime == before:
+                self.mtime = os.stat(self.root_path).st_mtime_ns
+
+    def add(self, name):
+        """
+        Record a file just created by this server
+        """
+        with self.lock:
+            i = bisect.bisect_left(self.names, name)
+            if i == len(self.names) or self.names[i] != name:
+                self.names.insert(i, name)
+                self.listing = None
+
+    def list(self, prefix=b'', offset=0, limit=None):
+        """
+        Names starting with prefix, in sorted order
+        :return: (listing bytes with one name per line, number of names matching prefix)
+        """
+        with self.lock:
+            self.refresh()
+            if not prefix and offset == 0 and limit is None:
+                if self.listing is None:
+                    self.listing = b"".join(name + b"\n" for name in self.names)
+                return self.listing, len(self.names)
+
+            start = bisect.bisect_left(self.names, prefix)
+            upper = self.prefix_upper_bound(prefix)
+            end = bisect.bisect_left(self.names, upper) if upper is not None else len(self.names)
+            page_start = min(start + offset, end)
+            page_end = end if limit is None else min(page_start + limit, end)
+            page = self.names[page_start:page_end]
+        return b"".join(name + b"\n" for name in page), end - start
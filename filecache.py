@@ -0,0 +1,112 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class CacheEntry:
+    def __init__(self, version, content, headers=None):
+        self.version = version  # (inode, size, mtime) of the file when content was read
+        self.content = content
+        self.headers = headers  # response headers built once for this version of the file
+        self.variants = dict()  # content-coding -> encoded content, None if encoding does not make it smaller
+
+    def nbytes(self):
+        return len(self.content) + sum(len(v) for v in self.variants.values() if v is not None)
+
+
+class FileCache:
+    """
+    LRU cache of file contents bounded by the total size of the cached contents.
+    An entry is only used while os.stat of the file still matches the inode, size and mtime
+    it was read with, so files changed by anybody are never served stale.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=1024 * 1024):
+        """
+        :param max_bytes: budget for the sum of cached content sizes, 0 disables the cache
+        :param max_entry_bytes: files larger than this are never cached
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.entries = OrderedDict()  # path -> CacheEntry, least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def version_of(st):
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def get(self, path):
+        """
+        :return: CacheEntry of path if it is cached and the file has not changed since, otherwise None
+        """
+        try:
+            version = self.version_of(os.stat(path))
+        except OSError:
+            version = None
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.version == version:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.remove(path)
+            self.misses += 1
+            return None
+
+    def put(self, path, st, content, headers=None):
+        """
+        Cache content read from path, st is os.fstat of the file it was read from
+        :param headers: response headers to keep with the content
+        :return: the new CacheEntry, or None if content is too large to be cached
+        """
+        if len(content) > self.max_entry_bytes:
+            return None
+        entry = CacheEntry(self.version_of(st), content, headers)
+        with self.lock:
+            if path in self.entries:
+                self.remove(path)
+            self.entries[path] = entry
+            self.size += len(content)
+            self.evict()
+        return entry
+
+    def put_variant(self, path, entry, encoding, data):
+        """
+        Keep an encoded (e.g. gzip) copy of entry's content, it counts against the byte budget
+        and goes away together with the entry
+        :param data: encoded content, None to remember that this encoding is not worth it
+        """
+        with self.lock:
+            if self.entries.get(path) is not entry or encoding in entry.variants:
+                # the entry has been replaced or evicted meanwhile
+                return
+            entry.variants[encoding] = data
+            self.size += len(data) if data is not None else 0
+            self.evict()
+
+    def evict(self):
+        # caller holds self.lock
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes()
+            self.evictions += 1
+
+    def invalidate(self, path):
+        with self.lock:
+            if path in self.entries:
+                self.remove(path)
+
+    def remove(self, path):
+        # caller holds self.lock
+        entry = self.entries.pop(path)
+        self.size -= entry.nbytes()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.size}
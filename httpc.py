@@ -1,12 +1,52 @@
 import argparse
+import sys
+import time
 import httplib
 
+
+def stream_to_file(response, path, progress=False):
+    """
+    Write the body of a streamed response to path chunk by chunk, without holding it in memory
+    :param progress: print bytes received and throughput to stderr while downloading
+    :return: number of bytes written
+    """
+    total = response.content_length()
+    written = 0
+    start = time.monotonic()
+    last_report = start
+    with open(path, 'wb') as fo:
+        for chunk in response.iter_chunks():
+            fo.write(chunk)
+            written += len(chunk)
+            now = time.monotonic()
+            if progress and now - last_report >= 0.2:
+                last_report = now
+                report_progress(written, total, now - start)
+    if progress:
+        report_progress(written, total, time.monotonic() - start)
+        sys.stderr.write('\n')
+    return written
+
+
+def report_progress(written, total, elapsed):
+    rate = written / elapsed / 1e6 if elapsed > 0 else 0.0
+    if total:
+        # the total is the encoded length, a compressed body can write more than that
+        sys.stderr.write('\r%d / %d bytes (%.0f%%) %.2f MB/s ' % (written, total, 100.0 * min(written, total) / total,
+                                                                   rate))
+    else:
+        sys.stderr.write('\r%d bytes %.2f MB/s ' % (written, rate))
+    sys.stderr.flush()
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(prog="httpc", add_help=False, usage="python httpc.py (get|post) [options...] URL")
+    parser = argparse.ArgumentParser(prog="httpc", add_help=False, usage="python httpc.py (get|post) [options...] URL\n"
+                                                                      "       python httpc.py batch [-j N] [MANIFEST]")
 
     # positional arguments
-    parser.add_argument("method", help="get or post method", type=str.lower, choices=['get', 'post'])
-    parser.add_argument("URL", help="URL", type=str)
+    parser.add_argument("method", help="get or post method, or batch to run the requests of a JSONL manifest",
+                        type=str.lower, choices=['get', 'post', 'batch'])
+    parser.add_argument("URL", help="URL, or for batch the manifest file, stdin if omitted or '-'", type=str,
+                        nargs="?")
 
     # optional arguments
     parser.add_argument("--help", action="help", help="show this help message and exit")
@@ -19,33 +59,80 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--output", help="output to file", type=str)
 
     parser.add_argument("-h", "--header", help="header", type=str, action="append")
+    parser.add_argument("--cache", help="directory of cached GET responses, revalidated with the server",
+                        type=str)
+    parser.add_argument("--resume", help="continue a download into an existing '-o' file", action="store_true")
+    parser.add_argument("--parallel", help="download into '-o' file as N ranges over N connections", type=int)
+    parser.add_argument("--progress", help="with '-o', show bytes received and throughput",
+                        action="store_true")
+    parser.add_argument("-j", "--jobs", help="batch: max number of requests in flight", type=int, default=8)
+
+    # intermixed, so that the optional URL positional can still come after the options
+    args = parser.parse_intermixed_args()
 
-    args = parser.parse_args()
+    if args.method == 'batch':
+        # results are streamed to stdout, or to '-o', as JSONL
+        out = open(args.output, 'w') if args.output else sys.stdout
+        if args.URL in (None, '-'):
+            failed = httplib.run_batch(sys.stdin, out, jobs=args.jobs)
+        else:
+            with open(args.URL, 'r') as manifest:
+                failed = httplib.run_batch(manifest, out, jobs=args.jobs)
+        if out is not sys.stdout:
+            out.close()
+        exit(1 if failed else 0)
+
+    if args.URL is None:
+        parser.error("the following arguments are required: URL")
     url = args.URL
     headers = args.header
 
-    response = ""
     if args.method == 'get':
         if args.data or args.file:
             print("Cannot use '-d' or '-f' in GET method")
             exit(1)
-        response = httplib.send_request('get', url, headers, verbose=args.verbose)
+        if args.resume or args.parallel:
+            if not args.output:
+                print("'--resume' and '--parallel' need '-o'")
+                exit(1)
+            if args.parallel:
+                written = httplib.download_parallel(url, args.output, args.parallel, headers)
+            else:
+                written = httplib.download_resume(url, args.output, headers)
+            print("%d bytes written to %s" % (written, args.output))
+            exit(0)
 
+    body = ''
     if args.method == 'post':
-        body = ''
         if args.data:
             body = args.data
         elif args.file:
             filename = args.file
             with open(filename, 'r') as f:
                 body = str.strip(f.read())
+
+    if args.output and not args.cache:
+        # the body goes to the file as it arrives, in binary, the request and header to stdout with -v
+        with httplib.open_response(args.method, url, headers, body=body) as response:
+            if args.verbose:
+                sys.stdout.buffer.write(response.request + b'\n\n' + response.header_str + b'\r\n\r\n')
+                sys.stdout.flush()
+            stream_to_file(response, args.output, args.progress)
+        exit(0)
+
+    if args.method == 'get':
+        validators = httplib.ValidatorCache(args.cache) if args.cache else None
+        response = httplib.send_request('get', url, headers, verbose=args.verbose, validators=validators)
+    else:
         response = httplib.send_request('post', url, headers, verbose=args.verbose, body=body)
 
     if args.output:
-        with open(args.output, "w") as fo:
-            fo.write(response.decode('ascii'))
+        with open(args.output, "wb") as fo:
+            fo.write(response)
     else:
-        print(response.decode('ascii'))
+        # the body is written as it is, it may be UTF-8 text or binary
+        sys.stdout.buffer.write(response + b'\n')
+        sys.stdout.flush()
 
 
 
@@ -1,27 +1,132 @@
 import socket
 import argparse
+import asyncio
+import gzip
 import threading
-from datetime import datetime
+import queue
+import select
+import shutil
+import signal
+import sys
+import tempfile
+import zlib
+import time
+from email.utils import formatdate, parsedate_to_datetime
 
 import utils
 import os
+from filecache import FileCache
+from dirindex import DirectoryIndex
+from responsebuilder import ResponseBuilder
+from pathlock import PathLockManager
+import httpparser
+from httpparser import parse_request_header, RequestHeaderTooLarge
+from urllib.parse import unquote_to_bytes
+
+
+class FileRange:
+    """
+    `count` bytes of an open file starting at `offset`, sent with sendfile
+    """
+    def __init__(self, f, offset, count):
+        self.f = f
+        self.offset = offset
+        self.count = count
+
+    def __repr__(self):
+        return "FileRange(%s, %d, %d)" % (self.f.name, self.offset, self.count)
+
+
+class CompressedFile:
+    """
+    An open file compressed while it is sent, in chunks, for files too large to be cached.
+    Its length is not known in advance, it is sent with Transfer-Encoding: chunked
+    """
+    def __init__(self, f, encoding, count, level=6):
+        self.f = f
+        # the file may grow meanwhile, only the first count bytes match its ETag
+        self.count = count
+        # wbits 31 writes a gzip header and trailer, 15 the zlib format of 'deflate'
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+
+    def __iter__(self):
+        remaining = self.count
+        while remaining > 0:
+            data = self.f.read(min(remaining, utils.BODY_CHUNK_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+            data = self.compressor.compress(data)
+            if data:
+                yield data
+        yield self.compressor.flush()
+
+    def __repr__(self):
+        return "CompressedFile(%s)" % self.f.name
+
+
+class SpooledBody:
+    """
+    Request body the asyncio engine has already written to a temporary file in the root directory
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(utils.BODY_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
 
 
 class HttpFs:
-    def __init__(self, host, port, root_path, verbose):
+    MAX_RANGES = 16  # a Range header with more ranges is ignored
+
+    def __init__(self, host, port, root_path, verbose, idle_timeout=15, backlog=128, max_connections=1024,
+                 pool_size=16, queue_depth=64, max_body_size=1 << 30, file_cache=None, compress_min_size=1024,
+                 max_header_fields=httpparser.MAX_HEADER_FIELDS, max_header_line=httpparser.MAX_LINE_LENGTH,
+                 lock_stripes=256):
         self.host = host
         # self.root_path = root_path
         self.root_path = os.path.abspath(root_path)
         self.port = port
         self.verbose = verbose
+        self.idle_timeout = idle_timeout        # seconds a keep-alive connection may wait for the next request
+        self.backlog = backlog                  # listen() backlog of pending connections
+        self.max_connections = max_connections  # max connections served at once by the asyncio engine
+        self.pool_size = pool_size              # number of worker threads of the pool engine
+        self.queue_depth = queue_depth          # max accepted connections waiting for a worker
+        self.accept_queue = None                # queue of (conn, addr, accept time) of the pool engine
+        self.draining = False                   # set on shutdown, connections are closed after their request
+        self.max_body_size = max_body_size      # max size of a POST body, larger ones are answered with 413
+        self.file_cache = file_cache or FileCache()
+        self.dir_index = DirectoryIndex(self.root_path)
+        self.response_builder = ResponseBuilder()
+        self.path_locks = PathLockManager(lock_stripes)  # GETs of a path share its lock, POSTs take it alone
+        self.compress_min_size = compress_min_size  # smallest file sent compressed, None disables compression
+        self.max_header_fields = max_header_fields  # requests with more header fields are answered with 431
+        self.max_header_line = max_header_line      # longer request or header lines are answered with 431
         print(os.path.abspath(root_path))
 
-    def run_server(self):
+    def make_listener(self, reuse_port=False):
         listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # every worker process binds its own listener, the kernel balances connections among them
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(self.backlog)
+        return listener
+
+    def run_server(self, listener=None):
+        """
+        Threaded engine, one thread per connection
+        """
+        listener = listener or self.make_listener()
 
         try:
-            listener.bind((self.host, self.port))
-            listener.listen(5)
             print('Echo server is listening at ', self.port)
             while True:
                 conn, addr = listener.accept()
@@ -29,116 +134,793 @@ class HttpFs:
         finally:
             listener.close()
 
+    def run_server_pool(self, listener=None):
+        """
+        Pool engine, pool_size worker threads fed by a bounded queue of accepted connections.
+        When the queue is full the connection is answered with 503 right away.
+        On exit (e.g. SystemExit from SIGTERM) it stops accepting, then lets the workers serve
+        the connections in progress and in the queue before returning.
+        """
+        listener = listener or self.make_listener()
+        self.accept_queue = queue.Queue(maxsize=self.queue_depth)
+        workers = [threading.Thread(target=self.pool_worker, daemon=True) for _ in range(self.pool_size)]
+        for t in workers:
+            t.start()
+
+        try:
+            print('Echo server (pool) is listening at ', self.port)
+            while True:
+                conn, addr = listener.accept()
+                try:
+                    self.accept_queue.put_nowait((conn, addr, time.monotonic()))
+                except queue.Full:
+                    self.reject_client(conn, addr)
+        finally:
+            listener.close()
+            self.draining = True
+            # one None per worker, behind the queued connections; a non-empty queue also makes
+            # workers give up idle keep-alive connections
+            for _ in workers:
+                self.accept_queue.put(None)
+            for t in workers:
+                t.join()
+
+    def pool_worker(self):
+        while True:
+            item = self.accept_queue.get()
+            if item is None:
+                return
+            conn, addr, accept_time = item
+            if self.verbose:
+                print("Connection from", addr, "waited %.3f ms in queue" % ((time.monotonic() - accept_time) * 1000))
+            try:
+                self.handle_client(conn, addr)
+            except Exception as e:
+                # a bug in a handler must not cost the pool a worker
+                print("Error serving", addr, "%s: %s" % (type(e).__name__, e))
+
+    def wait_for_request(self, conn):
+        """
+        Pool engine: wait until conn is readable, but give the worker up as soon as
+        other connections are waiting in the queue or after idle_timeout
+        :return: True if conn is readable
+        """
+        deadline = time.monotonic() + self.idle_timeout
+        while time.monotonic() < deadline:
+            readable, _, _ = select.select([conn], [], [], 0.05)
+            if readable:
+                return True
+            if not self.accept_queue.empty():
+                return False
+        return False
+
+    def reject_client(self, conn, addr):
+        if self.verbose:
+            print("Queue is full, rejecting", addr)
+        try:
+            conn.sendall(self.make_http_response(503, b"Server is busy, please retry later", keep_alive=False,
+                                                 extra_headers={'Retry-After': 1}))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def run_server_asyncio(self, listener=None):
+        """
+        asyncio engine, all connections are served by one event loop, which hands the
+        handling of each request to the threads of the default executor
+        """
+        asyncio.run(self.serve_asyncio(listener or self.make_listener()))
+
+    async def serve_asyncio(self, listener):
+        """
+        Serve until SIGTERM, then stop accepting, close idle connections and wait for the
+        requests in progress to be answered
+        """
+        connection_slots = asyncio.Semaphore(self.max_connections)
+        handlers = set()       # tasks of all open connections
+        idle_handlers = set()  # tasks of connections waiting for their next request
+
+        async def on_client(reader, writer):
+            task = asyncio.current_task()
+            handlers.add(task)
+            try:
+                # connections above max_connections wait here until a slot is free
+                async with connection_slots:
+                    await self.handle_client_asyncio(reader, writer, idle_handlers)
+            finally:
+                handlers.discard(task)
+
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        server = await asyncio.start_server(on_client, sock=listener)
+        print('Echo server (asyncio) is listening at ', self.port)
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            self.draining = True
+            for task in idle_handlers:
+                task.cancel()
+            if handlers:
+                await asyncio.wait(handlers)
+
+    def run_workers(self, engine, workers):
+        """
+        Fork `workers` processes serving the same port with `engine`, and supervise them:
+        a worker that dies is restarted, SIGTERM is forwarded to all workers.
+        Each worker binds its own SO_REUSEPORT listener if the platform has it,
+        otherwise all workers share one listener created before forking.
+        """
+        reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        shared_listener = None if reuse_port else self.make_listener()
+        # POSTs and GETs of a path in different workers must exclude each other as well
+        self.path_locks.share_with_children()
+        children = dict()  # pid -> last start time
+        stopping = [False]
+
+        def start_worker():
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                try:
+                    listener = shared_listener or self.make_listener(reuse_port=True)
+                    engine(listener)
+                finally:
+                    # the pool and asyncio engines return once their connections are served,
+                    # threads of the threaded engine are waited for here
+                    for t in threading.enumerate():
+                        if t is not threading.current_thread() and not t.daemon:
+                            t.join()
+                    os._exit(0)
+            children[pid] = time.monotonic()
+
+        def stop(signum, frame):
+            stopping[0] = True
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for _ in range(workers):
+            start_worker()
+        print('Supervisor started %d workers' % workers)
+
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = children.pop(pid, None)
+            if stopping[0] or started is None:
+                continue
+            print('Worker %d exited with status %d, restarting' % (pid, status))
+            # do not restart in a tight loop if workers die right after starting
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            start_worker()
+        if shared_listener:
+            shared_listener.close()
+        print('All workers stopped')
+
     def handle_client(self, conn, addr):
         print('New client from', addr)
+        conn.settimeout(self.idle_timeout)
+        reader = utils.SocketReader(conn, 4096)
+        try:
+            # serve requests on this connection one after another, pipelined requests
+            # are already buffered in reader and are answered in order
+            while True:
+                if self.accept_queue is not None and not reader.buffered() and not self.wait_for_request(conn):
+                    break
+                header_str = utils.read_http_head(reader)
+                if not header_str:
+                    break
+                body = utils.iter_http_body(reader, header_str, is_request=True, max_size=self.max_body_size)
+                # refuse a body known to be too large before answering, even if the handler would not read it
+                content_length = utils.get_header_value(header_str, b'content-length')
+                if content_length is not None and int(content_length) > self.max_body_size:
+                    raise utils.BodyTooLarge("Body is larger than {} bytes".format(self.max_body_size))
+
+                # a pool worker does not keep an idle connection while others wait in the queue
+                allow_keep_alive = self.accept_queue is None or self.accept_queue.empty()
+                head, msg, keep_alive = self.handle_request(header_str, body, allow_keep_alive)
+                self.send_response(conn, head, msg)
+                if not keep_alive:
+                    break
+                # skip the part of the body the handler did not read, before reading the next request
+                try:
+                    for _ in body:
+                        pass
+                except ValueError:
+                    # the response has been sent already, a body that is too large or badly framed
+                    # only ends the connection
+                    break
+
+        except socket.timeout:
+            if self.verbose:
+                print("Idle connection from", addr, "timed out")
+        except utils.BodyTooLarge:
+            conn.sendall(self.make_http_response(413, b"Request body is too large", keep_alive=False))
+        except RequestHeaderTooLarge:
+            conn.sendall(self.make_http_response(431, b"Request header is too large", keep_alive=False))
+        except ValueError:
+            # malformed request line, header line or framing, or a header larger than utils.MAX_HEADER_SIZE
+            conn.sendall(self.make_http_response(400, b"Bad Request", keep_alive=False))
+        except ConnectionError:
+            pass
+        finally:
+            conn.close()
+
+    async def handle_client_asyncio(self, reader, writer, idle_handlers=None):
+        """
+        :param idle_handlers: set the task is in while waiting for the next request, to be cancelled on shutdown
+        """
+        addr = writer.get_extra_info('peername')
+        print('New client from', addr)
+        task = asyncio.current_task()
+        idle_handlers = set() if idle_handlers is None else idle_handlers
+        try:
+            while True:
+                idle_handlers.add(task)
+                try:
+                    header_str = await asyncio.wait_for(utils.read_http_head_async(reader), self.idle_timeout)
+                finally:
+                    idle_handlers.discard(task)
+                if not header_str:
+                    break
+
+                body = await self.spool_body_asyncio(reader, header_str)
+                try:
+                    # file reads, compression, appends and path locks block, keep them off the event loop
+                    head, msg, keep_alive = await asyncio.get_running_loop().run_in_executor(
+                        None, self.handle_request, header_str, body, not self.draining)
+                finally:
+                    if isinstance(body, SpooledBody):
+                        # handle_post_request renames it over the target, anything else leaves it behind
+                        self.remove_temp_file(body.path)
+                await self.send_response_asyncio(writer, head, msg)
+                if not keep_alive or self.draining:
+                    break
+
+        except asyncio.TimeoutError:
+            if self.verbose:
+                print("Idle connection from", addr, "timed out")
+        except utils.BodyTooLarge:
+            writer.write(self.make_http_response(413, b"Request body is too large", keep_alive=False))
+        except RequestHeaderTooLarge:
+            writer.write(self.make_http_response(431, b"Request header is too large", keep_alive=False))
+        except ValueError:
+            writer.write(self.make_http_response(400, b"Bad Request", keep_alive=False))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def spool_body_asyncio(self, reader, header_str):
+        """
+        Read the body of a request, so the event loop is never blocked on the client by a handler.
+        A POST body is streamed to a temporary file in the root directory, which handle_post_request
+        renames over the target; the body of any other request is read and dropped.
+        :return: SpooledBody of a POST, an empty list otherwise
+        """
+        chunks = utils.iter_http_body_async(reader, header_str, is_request=True, max_size=self.max_body_size)
+        if not header_str.startswith(b'POST '):
+            async for _ in chunks:
+                pass
+            return []
+
+        tmp_paths = []
+        tmp_path = self.make_temp_file(os.path.join(self.root_path, b'upload'), tmp_paths)
         try:
-            data = utils.recvall(conn, 4096)
+            with open(tmp_path, 'wb') as f:
+                async for chunk in chunks:
+                    f.write(chunk)
+        except BaseException:
+            self.remove_temp_file(tmp_path)
+            raise
+        return SpooledBody(tmp_path)
+
+    def handle_request(self, header_str, body, allow_keep_alive=True):
+        """
+        Serve one request, shared by all engines
+        :param body: iterable of bytes chunks of the request body, or a SpooledBody
+        :param allow_keep_alive: False to close the connection after this response
+        :return: (response header as a list of bytes, body, keep_alive),
+                 body is bytes, a FileRange, a CompressedFile, or a list of bytes and FileRange parts
+        """
+        header = self.parse_header(header_str)
 
-            # split request into header and body
-            header_str = data.split(b'\r\n\r\n')[0].strip()
-            body_str = data[len(header_str):].strip()
+        if self.verbose:
+            print("\nRequest header is: \n" + str(header))
 
-            # parse header string to a dictionary
-            header = self.parse_header(header_str)
+        msg = b""
+        status = 0
+        headers = None
+        try:
+            if header.method == b'GET':
+                status, msg, headers = self.handle_get_request(header, body)
 
-            if self.verbose:
-                print("\nRequest header is: \n" + str(header))
-                print("\nRequest body is: \n" + str(body_str))
+            elif header.method == b'POST':
+                status, msg, headers = self.handle_post_request(header, body)
 
-            msg = b""
-            status = 0
-            if header[b'method'].lower() == b'get':
-                status, msg = self.handle_get_request(header, body_str)
+            else:
+                status, msg, headers = 405, b"Method Not Allowed", {'Allow': 'GET, POST'}
+        except (ConnectionError, socket.timeout):
+            raise
+        except OSError as e:
+            # e.g. a path lock that could not be taken, the client still gets an answer
+            print("Error serving", header.method, header.path, "%s: %s" % (type(e).__name__, e))
+            status, msg, headers = 500, b"Internal Server Error", None
 
-            elif header[b'method'].lower() == b'post':
-                status, msg = self.handle_post_request(header, body_str)
+        if self.verbose:
+            print("\nResponse status code is: " + str(status))
+            print("\nResponse msg is :\n" + str(msg))
 
-            if self.verbose:
-                print("\nResponse status code is: " + str(status))
-                print("\nResponse msg is :\n" + str(msg))
+        keep_alive = allow_keep_alive and self.is_keep_alive(header)
+        head = self.make_http_header(status, self.body_length(msg), keep_alive, headers)
 
-            response = self.make_http_response(status, msg)
+        if self.verbose:
+            print("\nResponse sent to client is:\n" + str(b"".join(head)) + str(msg))
 
-            if self.verbose:
-                print("\nResponse sent to client is:\n" + str(response))
+        return head, msg, keep_alive
 
-            conn.sendall(response)
+    @staticmethod
+    def body_length(msg):
+        """
+        :return: length of the body, None for a CompressedFile
+        """
+        if isinstance(msg, CompressedFile):
+            return None
+        parts = msg if isinstance(msg, list) else [msg]
+        return sum(part.count if isinstance(part, FileRange) else len(part) for part in parts)
 
+    @staticmethod
+    def send_response(conn, head, msg):
+        """
+        Send the response header, then the body. Header pieces and bytes parts are gathered by sendmsg
+        without being joined, file parts are sent with socket.sendfile, so their content is copied
+        by the kernel and never read into memory. A CompressedFile is sent in chunks as it is compressed.
+        """
+        parts = msg if isinstance(msg, list) else [msg]
+        try:
+            pending = list(head)
+            for part in parts:
+                if isinstance(part, CompressedFile):
+                    utils.sendmsg_all(conn, pending)
+                    pending = [b'0\r\n\r\n']
+                    for data in part:
+                        if data:
+                            utils.sendmsg_all(conn, [b'%x\r\n' % len(data), data, b'\r\n'])
+                elif isinstance(part, FileRange):
+                    utils.sendmsg_all(conn, pending)
+                    pending = []
+                    if part.count:
+                        conn.sendfile(part.f, part.offset, part.count)
+                else:
+                    pending.append(part)
+            utils.sendmsg_all(conn, pending)
         finally:
-            conn.close()
+            for part in parts:
+                if isinstance(part, (FileRange, CompressedFile)):
+                    part.f.close()
 
+    @staticmethod
+    async def send_response_asyncio(writer, head, msg):
+        if isinstance(msg, bytes):
+            # one write, a header written alone would be held back by Nagle's algorithm
+            writer.writelines(head + [msg])
+            await writer.drain()
+            return
+        writer.writelines(head)
+        parts = msg if isinstance(msg, list) else [msg]
+        try:
+            loop = asyncio.get_running_loop()
+            for part in parts:
+                if isinstance(part, CompressedFile):
+                    # reading and compressing run in the executor, off the event loop
+                    chunks = iter(part)
+                    while True:
+                        data = await loop.run_in_executor(None, next, chunks, None)
+                        if data is None:
+                            break
+                        if data:
+                            writer.writelines([b'%x\r\n' % len(data), data, b'\r\n'])
+                            await writer.drain()
+                    writer.write(b'0\r\n\r\n')
+                elif isinstance(part, FileRange):
+                    if part.count:
+                        await writer.drain()
+                        await loop.sendfile(writer.transport, part.f, part.offset, part.count)
+                else:
+                    writer.write(part)
+            await writer.drain()
+        finally:
+            for part in parts:
+                if isinstance(part, (FileRange, CompressedFile)):
+                    part.f.close()
+
+    @staticmethod
+    def is_keep_alive(header):
+        """
+        HTTP/1.1 connections are persistent unless the client sends "Connection: close",
+        HTTP/1.0 connections only if the client sends "Connection: keep-alive"
+        """
+        connection = header.get(b'connection', b'').lower()
+        if header.http_version == b'HTTP/1.0':
+            return connection == b'keep-alive'
+        return connection != b'close'
 
-    def handle_get_request(self, header, body_str):
-        path = header[b'path']
+    def handle_get_request(self, header, body):
+        path, _, query = header.path.partition(b'?')
         if path == b'/':
-            files_list = os.listdir(self.root_path)
-            msg = b""
-            for file in files_list:
-                msg += (file + b"\n")
-            return 200, msg
+            return self.handle_list_request(query)
         else:
             file_path = os.path.abspath(self.root_path + path)
             if not self.is_safe_path(file_path):
-                return 400, b"Bad Request, cannot access files outside of directory!"
+                return 400, b"Bad Request, cannot access files outside of directory!", None
+
+            # the response, compressed or not, is built after the lock is released so that
+            # writers of the file do not wait for the compression
+            with self.path_locks.read(file_path):
+                error, opened = self.open_file(file_path)
+            if error is not None:
+                return error
+            return self.read_file(header, file_path, *opened)
+
+    def open_file(self, file_path):
+        """
+        Take the content of file_path from the cache, read it into the cache, or open it if it is too large,
+        the caller holds its read lock
+        :return: (error response, None), or (None, (source, size, version, headers, entry)) where source is
+                 the content as bytes or the open file, and entry its CacheEntry, None if it is not cached
+        """
+        entry = self.file_cache.get(file_path)
+        if self.verbose:
+            print("\nFile cache: " + str(self.file_cache.stats()))
+            print("\nPath locks: " + str(self.path_locks.stats()))
+        if entry is not None:
+            return None, (entry.content, len(entry.content), entry.version, entry.headers, entry)
+
+        try:
+            f = open(file_path, 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return (404, b"File does not exist", None), None
+        except PermissionError:
+            return (403, b"Forbidden", None), None
+
+        st = os.fstat(f.fileno())
+        headers = self.file_headers(st)
+        version = FileCache.version_of(st)
+        if st.st_size <= self.file_cache.max_entry_bytes:
+            with f:
+                content = f.read()
+            entry = self.file_cache.put(file_path, st, content, headers)
+            return None, (content, st.st_size, version, headers, entry)
+        # a large file stays open, it is streamed to the client and closed by send_response
+        return None, (f, st.st_size, version, headers, None)
+
+    def read_file(self, header, file_path, source, size, version, headers, entry):
+        """
+        Response for a GET of file_path, from what open_file returned
+        """
+        if self.is_not_modified(header, version, headers):
+            if not isinstance(source, bytes):
+                source.close()
+            return self.not_modified(header, size, headers, entry)
+        return self.make_file_response(header, source, size, headers, file_path, entry)
+
+    def not_modified(self, header, size, headers, entry=None):
+        """
+        304 response, with the ETag of the representation a 200 would have had, compressed or not,
+        see make_file_response
+        """
+        encoding = self.file_encoding(header, size, headers, size > self.file_cache.max_entry_bytes, entry)
+        if encoding is not None:
+            headers = dict(headers, ETag=self.variant_etag(headers['ETag'], encoding))
+        return 304, b"", headers
+
+    def file_encoding(self, header, size, headers, streamed, entry=None):
+        """
+        Content-Encoding of the full response for a file, None to send it as it is
+        :param streamed: whether the file is too large for the cache and is compressed while sent
+        :param entry: CacheEntry of the file, its variants tell whether compressing it is worth it
+        """
+        if self.parse_range(header, size, headers) is not None:
+            return None
+        if streamed and header.http_version != b'HTTP/1.1':
+            # a compressed stream is sent chunked, which HTTP/1.0 clients do not understand
+            return None
+        encoding = self.choose_encoding(header, size)
+        # the variant is None once compressing the content turned out not to make it smaller
+        if encoding is not None and entry is not None and entry.variants.get(encoding, b'') is None:
+            return None
+        return encoding
+
+    @staticmethod
+    def file_headers(st):
+        """
+        ETag and Last-Modified of a file, the ETag changes whenever inode, size or mtime change
+        """
+        etag = '"%x-%x-%x"' % FileCache.version_of(st)
+        return {'ETag': etag, 'Last-Modified': formatdate(st.st_mtime, usegmt=True), 'Accept-Ranges': 'bytes',
+                'Vary': 'Accept-Encoding'}
+
+    def make_file_response(self, header, source, size, headers, file_path=None, entry=None):
+        """
+        Full (200), compressed (200) or partial (206 / 416) response for the content of a file
+        :param source: content of the file as bytes, or the open file
+        :param size: size of the file
+        :param headers: file_headers of the file, not modified
+        :param file_path: path of the file, to cache compressed content with its entry
+        :param entry: CacheEntry of source, None if source is not cached
+        """
+        def piece(start, end):
+            if isinstance(source, bytes):
+                return source[start:end + 1]
+            return FileRange(source, start, end - start + 1)
+
+        ranges = self.parse_range(header, size, headers)
+        if ranges is None:
+            encoding = self.file_encoding(header, size, headers, not isinstance(source, bytes), entry)
+            if encoding is not None:
+                encoded_headers = dict(headers, **{'Content-Encoding': encoding,
+                                                   'ETag': self.variant_etag(headers['ETag'], encoding)})
+                if not isinstance(source, bytes):
+                    # files too large for the cache are compressed while they are sent
+                    return 200, CompressedFile(source, encoding, size), encoded_headers
+                data = self.encode_content(source, encoding, file_path, entry)
+                if data is not None:
+                    return 200, data, encoded_headers
+            return 200, piece(0, size - 1), headers
+
+        if not ranges:
+            if not isinstance(source, bytes):
+                source.close()
+            return 416, b"Range Not Satisfiable", dict(headers, **{'Content-Range': 'bytes */%d' % size})
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            return 206, piece(start, end), dict(headers, **{'Content-Range': 'bytes %d-%d/%d' % (start, end, size)})
+
+        boundary = os.urandom(12).hex()
+        parts = []
+        for start, end in ranges:
+            parts.append(('\r\n--%s\r\nContent-Type: text/plain\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                          % (boundary, start, end, size)).encode('ascii'))
+            parts.append(piece(start, end))
+        parts.append(('\r\n--%s--\r\n' % boundary).encode('ascii'))
+        if isinstance(source, bytes):
+            parts = b"".join(parts)
+        return 206, parts, dict(headers, **{'Content-Type': 'multipart/byteranges; boundary=' + boundary})
+
+    def choose_encoding(self, header, size):
+        """
+        Pick gzip or deflate from the Accept-Encoding of the request
+        :return: 'gzip', 'deflate' or None for identity
+        """
+        if self.compress_min_size is None or size < self.compress_min_size:
+            return None
+        accept_encoding = header.get(b'accept-encoding')
+        if not accept_encoding:
+            return None
+        qvalues = dict()
+        for item in accept_encoding.decode('ascii', 'replace').lower().split(','):
+            coding, _, params = item.partition(';')
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            qvalues[coding.strip()] = q
+        for coding in ('gzip', 'deflate'):
+            if qvalues.get(coding, qvalues.get('*', 0.0)) > 0:
+                return coding
+        return None
+
+    def encode_content(self, content, encoding, file_path=None, entry=None):
+        """
+        Compressed content, taken from or added to the cache entry
+        :return: bytes, or None if compressing does not make content smaller
+        """
+        if entry is not None and encoding in entry.variants:
+            return entry.variants[encoding]
+        data = self.compress(content, encoding)
+        if len(data) >= len(content):
+            data = None
+        if entry is not None:
+            self.file_cache.put_variant(file_path, entry, encoding, data)
+        return data
 
+    @staticmethod
+    def compress(content, encoding, level=6):
+        if encoding == 'gzip':
+            return gzip.compress(content, compresslevel=level, mtime=0)
+        return zlib.compress(content, level)
+
+    @staticmethod
+    def variant_etag(etag, encoding):
+        # a compressed response is a different representation and needs its own strong ETag
+        return etag[:-1] + '-' + encoding + '"'
+
+    def parse_range(self, header, size, headers):
+        """
+        Parse a "Range: bytes=..." header against a file of `size` bytes
+        :return: None to send the whole file (no Range, an invalid one, or a failed If-Range),
+                 otherwise the list of satisfiable (first, last) byte positions, empty if there is none
+        """
+        range_value = header.get(b'range')
+        if range_value is None or not range_value.startswith(b'bytes='):
+            return None
+        if_range = header.get(b'if-range')
+        if if_range is not None and if_range.decode('ascii', 'replace') not in (headers['ETag'],
+                                                                                headers['Last-Modified']):
+            return None
+
+        specs = range_value[len(b'bytes='):].split(b',')
+        if len(specs) > self.MAX_RANGES:
+            return None
+        ranges = []
+        for spec in specs:
+            first, sep, last = spec.strip().partition(b'-')
+            if not sep:
+                return None
             try:
-                with open(file_path, 'r') as f:
-                    content = f.read().encode('ascii')
-                    return 200, content
-            except FileNotFoundError:
-                return 404, b"File does not exist"
+                if not first:
+                    # suffix range, the last n bytes
+                    start, end = max(0, size - int(last)), size - 1
+                else:
+                    start = int(first)
+                    end = min(int(last), size - 1) if last else size - 1
+                    if last and int(last) < start:
+                        return None
+            except ValueError:
+                return None
+            if start <= end:
+                ranges.append((start, end))
+        return ranges
+
+    def is_not_modified(self, header, version, headers):
+        """
+        Evaluate If-None-Match, or If-Modified-Since if there is no If-None-Match
+        :return: True if the client copy is still valid and 304 can be sent
+        """
+        if_none_match = header.get(b'if-none-match')
+        if if_none_match is not None:
+            etags = [t.strip() for t in if_none_match.split(b',')]
+            etag = headers['ETag']
+            valid = {etag, self.variant_etag(etag, 'gzip'), self.variant_etag(etag, 'deflate')}
+            return b'*' in etags or any(t.decode('ascii', 'replace') in valid for t in etags)
+
+        if_modified_since = header.get(b'if-modified-since')
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since.decode('ascii')).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return version[2] // 1000000000 <= since
+        return False
 
 
-    def handle_post_request(self, header, body_str):
-        append_mode = False
-        if b'append' in header and header[b'append'] == b'True':
-            append_mode = True
+    def handle_list_request(self, query):
+        """
+        List the root directory, one name per line in sorted order.
+        Query parameters: prefix (only names starting with it), offset and limit (a page of the result).
+        X-Total-Count is the number of names matching prefix.
+        """
+        params = dict()
+        for item in query.split(b'&'):
+            k, _, v = item.partition(b'=')
+            if k:
+                params[k] = unquote_to_bytes(v.replace(b'+', b' '))
+        try:
+            offset = int(params.get(b'offset', 0))
+            limit = int(params[b'limit']) if b'limit' in params else None
+        except ValueError:
+            return 400, b"Bad Request, offset and limit must be integers!", None
+        if offset < 0 or (limit is not None and limit < 0):
+            return 400, b"Bad Request, offset and limit must not be negative!", None
+
+        msg, total = self.dir_index.list(params.get(b'prefix', b''), offset, limit)
+        return 200, msg, {'X-Total-Count': total}
 
-        path = header[b'path']
+    def handle_post_request(self, header, body):
+        """
+        Stream the body to a temporary file next to the target, then rename it over the target,
+        so readers see either the old or the new content, never a partial write.
+        An append to an existing file copies the body to its end in place with O_APPEND instead.
+        Only the rename or the append happen under the write lock of the path,
+        so a slow upload does not hold up readers or other writers of the file.
+        """
+        append_mode = header.get(b'append', b'').lower() == b'true'
+
+        path = header.path.partition(b'?')[0]
         if path == b'/':
-            return 400, b"Bad request, please provide a file name!"
+            return 400, b"Bad request, please provide a file name!", None
 
         else:
             file_path = os.path.abspath(self.root_path + path)
             if not self.is_safe_path(file_path):
-                return 400, b"Bad Request, cannot access files outside of directory!"
+                return 400, b"Bad Request, cannot access files outside of directory!", None
 
+            tmp_paths = []
             try:
-                write_mode = 'a' if append_mode else 'w'
-                with open(file_path, write_mode) as f:
-                    f.write(body_str.decode('ascii'))
-                    return 200, b"Write to file success!"
+                if isinstance(body, SpooledBody):
+                    # already on disk in the root directory, it only has to be renamed
+                    tmp_path = body.path
+                    tmp_paths.append(tmp_path)
+                    written = os.path.getsize(tmp_path)
+                else:
+                    tmp_path = self.make_temp_file(file_path, tmp_paths)
+                    with open(tmp_path, 'wb') as f:
+                        written = 0
+                        for chunk in body:
+                            f.write(chunk)
+                            written += len(chunk)
+
+                with self.path_locks.write(file_path):
+                    created = not os.path.exists(file_path)
+                    if append_mode and not created:
+                        # costs the size of the body, not of the file; readers wait on the lock,
+                        # so they never see half of the appended body
+                        with open(file_path, 'ab') as f:
+                            with open(tmp_path, 'rb') as new:
+                                shutil.copyfileobj(new, f)
+                    else:
+                        if created:
+                            os.chmod(tmp_path, 0o644)
+                        else:
+                            shutil.copymode(file_path, tmp_path)
+                        with self.dir_index.changing(os.path.dirname(file_path)):
+                            os.replace(tmp_path, file_path)
+                        tmp_paths.remove(tmp_path)
+                    self.file_cache.invalidate(file_path)
+
+                if created and os.path.dirname(file_path) == self.root_path:
+                    self.dir_index.add(os.path.basename(file_path))
+                if self.verbose:
+                    print("\nWrote %d bytes to %s" % (written, file_path))
+                    print("\nPath locks: " + str(self.path_locks.stats()))
+                return 200, b"Write to file success!", None
             except OSError:
-                return 500, b"Write to file failed!"
-
-
-    def make_http_response(self, status, msg):
-        result = b""
-        http_version = b'HTTP/1.1'
-        status_msg = b""
-        if status == 200:
-            status_msg = b"200 OK"
-        elif status == 400:
-            status_msg = b"400 Bad Request"
-        elif status == 404:
-            status_msg = b"404 Not Found"
-        elif status == 500:
-            status_msg = b"500 Internal Server Error"
-        result += (http_version + b" " + status_msg + b"\r\n")
-
-        datetime_str = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT").encode("ascii")
-        result += (b"Date: " + datetime_str + b"\r\n")
-        result += (b"Content-Type: " + b"text/plain\r\n")
-        result += (b"Content-Length: " + str(len(msg)).encode('ascii') + b"\r\n")
-        result += b"Connection: keep-alive\r\n"
-        result += b"Server: httpfs\r\n"
-        result += b"Access-Control-Allow-Origin: *\r\n"
-        result += b"Access-Control-Allow-Credentials: true\r\n"
-        result += b"\r\n"
-
-        result += msg
-
-        return result
+                return 500, b"Write to file failed!", None
+            finally:
+                for tmp_path in tmp_paths:
+                    self.remove_temp_file(tmp_path)
+
+    def make_temp_file(self, file_path, tmp_paths):
+        """
+        Create an empty hidden temporary file next to file_path and record it in tmp_paths for cleanup
+        """
+        with self.dir_index.changing(os.path.dirname(file_path)):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path),
+                                            prefix=b'.' + os.path.basename(file_path), suffix=b'.tmp')
+        os.close(fd)
+        tmp_paths.append(tmp_path)
+        return tmp_path
+
+    def remove_temp_file(self, tmp_path):
+        with self.dir_index.changing(os.path.dirname(tmp_path)):
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+
+
+    def make_http_response(self, status, msg, keep_alive=True, extra_headers=None):
+        return b"".join(self.make_http_header(status, len(msg), keep_alive, extra_headers)) + msg
+
+    def make_http_header(self, status, content_length, keep_alive=True, extra_headers=None):
+        """
+        :return: list of bytes, see ResponseBuilder.build
+        """
+        return self.response_builder.build(status, content_length, keep_alive, extra_headers)
 
 
     def is_safe_path(self, path):
@@ -146,38 +928,64 @@ class HttpFs:
 
 
     def list_filenames(self):
-        return os.listdir(self.root_path)
+        return self.dir_index.list()[0].splitlines()
 
 
-    @staticmethod
-    def parse_header(header_str):
+    def parse_header(self, header_str):
         """
-        Parse the header str received from request into a dictionary
+        Parse the header str received from request
         :param header_str: header string
-        :return: header dict
+        :return: httpparser.RequestHeader
         """
-        # print(header_str)
-        header = dict()
-        lines = header_str.split(b'\r\n')
-
-        tmp = lines[0].split(b' ')
-        header[b'method'] = tmp[0]
-        header[b'path'] = tmp[1]
-        header[b'http_version'] = tmp[2]
-
-        header_kv = utils.parse_str_list_to_dict(lines[1:])
-
-        header.update(header_kv)
-        # print(header)
-        return header
+        return parse_request_header(header_str, self.max_header_fields, self.max_header_line)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--port", help="port number of server", type=int, default=8080)
-    parser.add_argument("-d", "--directory", help="root path of this file server", type=bytes, default=b"FileServer/")
+    parser.add_argument("-d", "--directory", help="root path of this file server", type=os.fsencode,
+                        default=b"FileServer/")
     parser.add_argument("-v", "--verbose", help="verbose mode", action="store_true")
+    parser.add_argument("--idle-timeout", help="seconds to keep an idle connection open", type=float, default=15)
+    parser.add_argument("--engine", help="server engine", choices=['threaded', 'asyncio', 'pool'], default='threaded')
+    parser.add_argument("--backlog", help="listen backlog", type=int, default=128)
+    parser.add_argument("--max-connections", help="max concurrent connections of the asyncio engine",
+                        type=int, default=1024)
+    parser.add_argument("--pool-size", help="number of worker threads of the pool engine", type=int, default=16)
+    parser.add_argument("--queue-depth", help="max connections waiting for a worker of the pool engine",
+                        type=int, default=64)
+    parser.add_argument("--workers", help="number of server processes sharing the port", type=int, default=1)
+    parser.add_argument("--max-body-size", help="max size in bytes of a POST body", type=int, default=1 << 30)
+    parser.add_argument("--cache-size", help="bytes of file content cached in memory, 0 to disable",
+                        type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--cache-max-file", help="max size in bytes of a cached file", type=int, default=1024 * 1024)
+    parser.add_argument("--compress-min-size", help="smallest file in bytes sent gzip/deflate compressed, files "
+                        "too large for the cache are compressed while sent, chunked, to HTTP/1.1 clients",
+                        type=int, default=1024)
+    parser.add_argument("--no-compress", help="never compress responses", action="store_true")
+    parser.add_argument("--max-header-fields", help="max number of request header fields", type=int,
+                        default=httpparser.MAX_HEADER_FIELDS)
+    parser.add_argument("--max-header-line", help="max length of a request header line", type=int,
+                        default=httpparser.MAX_LINE_LENGTH)
+    parser.add_argument("--lock-stripes", help="size of the table of per-path reader/writer locks", type=int,
+                        default=256)
     args = parser.parse_args()
 
-    fs = HttpFs("", args.port, args.directory, args.verbose)
-    fs.run_server()
+    fs = HttpFs("", args.port, args.directory, args.verbose, idle_timeout=args.idle_timeout,
+                backlog=args.backlog, max_connections=args.max_connections,
+                pool_size=args.pool_size, queue_depth=args.queue_depth, max_body_size=args.max_body_size,
+                file_cache=FileCache(args.cache_size, args.cache_max_file),
+                compress_min_size=None if args.no_compress else args.compress_min_size,
+                max_header_fields=args.max_header_fields, max_header_line=args.max_header_line,
+                lock_stripes=args.lock_stripes)
+    if args.engine == 'asyncio':
+        run_engine = fs.run_server_asyncio
+    elif args.engine == 'pool':
+        run_engine = fs.run_server_pool
+    else:
+        run_engine = fs.run_server
+
+    if args.workers > 1:
+        fs.run_workers(run_engine, args.workers)
+    else:
+        run_engine()
@@ -1,44 +1,635 @@
-import socket
+import asyncio
+import gzip
+import hashlib
+import json
+import os
 import re
+import socket
+import select
+import threading
+import time
+import zlib
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 import utils
 
 
-def send_request(method, url, headers, verbose, body=''):
-    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+class PooledConnection:
+    def __init__(self, key, timeout=None):
+        self.key = key
+        self.sock = socket.create_connection(key, timeout=timeout)
+        self.reader = utils.SocketReader(self.sock, buffsize=4096)
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def is_alive(self):
+        """
+        An idle keep-alive connection must not be readable, otherwise the server
+        has closed it (or sent something we did not ask for)
+        """
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections keyed by (host, port). A connection is taken out of the pool
+    for one request/response exchange and put back if the server keeps it open.
+    """
+    def __init__(self, max_per_host=4, idle_timeout=30, connect_timeout=None):
+        """
+        :param max_per_host: max number of connections (idle + in use) to one (host, port)
+        :param idle_timeout: seconds an idle connection is kept before it is evicted
+        :param connect_timeout: socket timeout of new connections, None means blocking
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.idle = dict()    # (host, port) -> list of idle PooledConnection, most recent last
+        self.in_use = dict()  # (host, port) -> number of connections taken out of the pool
+        self.cond = threading.Condition()
+
+    def acquire(self, key):
+        """
+        Get an idle connection to key, or open a new one if the per-host cap allows it.
+        Block until a connection is released otherwise.
+        """
+        with self.cond:
+            while True:
+                self.evict_idle()
+                idle_conns = self.idle.get(key)
+                while idle_conns:
+                    pooled = idle_conns.pop()
+                    if pooled.is_alive():
+                        pooled.reused = True
+                        self.in_use[key] = self.in_use.get(key, 0) + 1
+                        return pooled
+                    pooled.close()
+                if self.in_use.get(key, 0) + len(self.idle.get(key, ())) < self.max_per_host:
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    break
+                self.cond.wait()
+
+        try:
+            return PooledConnection(key, timeout=self.connect_timeout)
+        except OSError:
+            self.release(None, key=key)
+            raise
+
+    def release(self, pooled, reusable=True, key=None):
+        """
+        Give a connection back to the pool, or close it if it cannot be reused
+        """
+        key = pooled.key if pooled else key
+        with self.cond:
+            self.in_use[key] -= 1
+            if pooled:
+                if reusable:
+                    pooled.last_used = time.monotonic()
+                    self.idle.setdefault(key, []).append(pooled)
+                else:
+                    pooled.close()
+            self.cond.notify_all()
+
+    def evict_idle(self):
+        """
+        Close connections that have been idle for more than idle_timeout
+        """
+        now = time.monotonic()
+        with self.cond:
+            for key in list(self.idle):
+                alive = []
+                for pooled in self.idle[key]:
+                    if now - pooled.last_used > self.idle_timeout:
+                        pooled.close()
+                    else:
+                        alive.append(pooled)
+                if alive:
+                    self.idle[key] = alive
+                else:
+                    del self.idle[key]
+
+    def close(self):
+        with self.cond:
+            for idle_conns in self.idle.values():
+                for pooled in idle_conns:
+                    pooled.close()
+            self.idle.clear()
+
+
+default_pool = ConnectionPool()
+
+
+class ValidatorCache:
+    """
+    Remember the ETag / Last-Modified validators and the body of GET responses, so that the next
+    GET of the same URL is sent with If-None-Match / If-Modified-Since and a 304 answer is served
+    from the cache. With a directory the cache is kept on disk and shared by httpc runs.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.entries = dict()  # url -> (etag, last_modified, body)
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def file_path(self, url, suffix):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + suffix)
+
+    def get(self, url):
+        """
+        :return: (etag, last_modified, body) or None, etag and last_modified are str or None
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry is not None or not self.directory:
+            return entry
+        try:
+            with open(self.file_path(url, '.json'), 'r') as f:
+                meta = json.load(f)
+            with open(self.file_path(url, '.body'), 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        entry = (meta.get('etag'), meta.get('last_modified'), body)
+        with self.lock:
+            self.entries[url] = entry
+        return entry
+
+    def put(self, url, etag, last_modified, body):
+        entry = (etag, last_modified, bytes(body))
+        with self.lock:
+            self.entries[url] = entry
+        if self.directory:
+            # body first, so that a meta file always has its body
+            for suffix, data in (('.body', entry[2]),
+                                 ('.json', json.dumps({'url': url, 'etag': etag,
+                                                       'last_modified': last_modified}).encode('utf-8'))):
+                tmp_path = self.file_path(url, suffix + '.tmp')
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.file_path(url, suffix))
+
+
+def send_request(method, url, headers, verbose, body='', pool=default_pool, validators=None):
+    """
+    Send a request, follow redirects and return the response. Connections are taken from `pool`,
+    pass pool=None to use a new connection which is closed after the response.
+    GET responses are revalidated with and stored in `validators`, a ValidatorCache, if given.
+    """
     if not url.startswith('http://'):
         url = 'http://' + url
-    parsed_url = urlparse(url)
 
-    try:
+    cached = validators.get(url) if validators is not None and method == 'get' else None
+    request_headers = headers
+    if cached is not None:
+        etag, last_modified, _ = cached
+        request_headers = list(headers or [])
+        if etag:
+            request_headers.append('If-None-Match: ' + etag)
+        if last_modified:
+            request_headers.append('If-Modified-Since: ' + last_modified)
+
+    response = open_response(method, url, request_headers, body=body, pool=pool)
+    response_body = response.read()
+    header_str = response.header_str
+
+    if cached is not None and response.status == 304:
+        response_body = cached[2]
+    elif validators is not None and method == 'get' and response.status == 200:
+        etag = response.header(b'etag')
+        last_modified = response.header(b'last-modified')
+        if etag or last_modified:
+            validators.put(url, etag and etag.decode('ascii'), last_modified and last_modified.decode('ascii'),
+                           response_body)
+
+    return construct_response(response.request, header_str, response_body, verbose)[0]
+
+
+def fetch(method, url, headers, body='', pool=default_pool, max_redirects=5):
+    """
+    Send a request and follow redirects
+    :return: (status code, header_str, body) of the final response
+    """
+    response = open_response(method, url, headers, body=body, pool=pool, max_redirects=max_redirects)
+    return response.status, response.header_str, response.read()
+
+
+class Response:
+    """
+    Response of open_response, returned as soon as its header has been received.
+    The body is read with iter_chunks() or read(); the connection goes back to the pool once
+    the body has been read to the end, call close() to give up on the rest of the body.
+    """
+    def __init__(self, url, request, header_str, pooled, pool):
+        self.url = url
+        self.request = request  # request message, header and body
+        self.header_str = header_str
+        self.status = int(header_str.split(b' ')[1])
+        self.pooled = pooled
+        self.pool = pool
+
+    def header(self, name):
+        """
+        :param name: lower case header name in bytes
+        :return: bytes or None
+        """
+        return utils.get_header_value(self.header_str, name)
+
+    def content_length(self):
+        """
+        :return: length of the body as sent (before decoding), None if unknown
+        """
+        value = self.header(b'content-length')
+        return int(value) if value is not None and not utils.is_chunked(self.header_str) else None
+
+    def iter_chunks(self, chunk_size=utils.BODY_CHUNK_SIZE):
+        """
+        Decoded body in chunks of at most chunk_size bytes (before decompression)
+        """
+        if self.pooled is None:
+            raise ValueError("Response body has already been consumed")
+        decoder = BodyDecoder(self.header_str)
+        try:
+            for data in utils.iter_http_body(self.pooled.reader, self.header_str, chunk_size=chunk_size):
+                data = decoder.decode(data)
+                if data:
+                    yield data
+            data = decoder.flush()
+            if data:
+                yield data
+        except BaseException:
+            self.close()
+            raise
+        self.finish()
+
+    def read(self):
+        body = bytearray()
+        for data in self.iter_chunks():
+            body += data
+        return bytes(body)
+
+    def finish(self):
+        """
+        The whole body has been read, the connection can be reused if the response was framed
+        """
+        pooled, self.pooled = self.pooled, None
+        if pooled is None:
+            return
+        connection = self.header(b'connection')
+        framed = utils.has_no_body(self.header_str) or utils.is_chunked(self.header_str) \
+            or self.header(b'content-length') is not None
+        release(self.pool, pooled, framed and (connection is None or connection.lower() != b'close'))
+
+    def close(self):
+        """
+        Drop the rest of the body and the connection
+        """
+        pooled, self.pooled = self.pooled, None
+        if pooled is not None:
+            release(self.pool, pooled, reusable=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def release(pool, pooled, reusable=True):
+    """
+    Give a connection back to pool, or close it if pool is None
+    """
+    if pool is None:
+        pooled.close()
+    else:
+        pool.release(pooled, reusable=reusable)
+
+
+def open_response(method, url, headers, body='', pool=default_pool, max_redirects=5):
+    """
+    Send a request, follow redirects and return the final Response without reading its body
+    """
+    for _ in range(max_redirects + 1):
+        if not url.startswith('http://'):
+            url = 'http://' + url
+        parsed_url = urlparse(url)
         port = 80 if parsed_url.port is None else parsed_url.port
-        conn.connect((parsed_url.hostname, port))
-        msg = construct_request(method, parsed_url, headers, body=body)
-        conn.sendall(msg)
-        response = utils.recvall(conn, buffsize=4096)
-        response, status_code = construct_response(msg, response, verbose)
-        if status_code.startswith(b"3"):
-            re_location = re.compile(b"location: ([\s\S]*?)\r\n", re.IGNORECASE)
-            new_url = re_location.findall(response)[0]
-            return send_request(method, new_url.decode('ascii'), headers, verbose, body='')
+        key = (parsed_url.hostname, port)
+        msg = construct_request(method, parsed_url, headers, body=body, keep_alive=pool is not None)
+
+        while True:
+            pooled = pool.acquire(key) if pool is not None else PooledConnection(key)
+            sent = False
+            try:
+                pooled.sock.sendall(msg)
+                sent = True
+                header_str = utils.read_http_head(pooled.reader)
+            except OSError:
+                release(pool, pooled, reusable=False)
+                if pooled.reused and can_resend(msg, sent):
+                    continue
+                raise
+            except BaseException:
+                release(pool, pooled, reusable=False)
+                raise
+            if not header_str:
+                release(pool, pooled, reusable=False)
+                if pooled.reused and can_resend(msg, sent):
+                    continue
+                raise ConnectionError("Server closed the connection without a response")
+            break
+
+        response = Response(url, msg, header_str, pooled, pool)
+        if response.status in (301, 302, 303, 307, 308) and response.header(b'location'):
+            response.read()
+            url = response.header(b'location').decode('ascii')
+            body = ''
+            continue
+        return response
+    raise ConnectionError("Too many redirects")
+
+
+class BodyDecoder:
+    """
+    Undo the Content-Encoding (gzip or deflate) of a response body read in chunks
+    """
+    def __init__(self, header_str):
+        encoding = (utils.get_header_value(header_str, b'content-encoding') or b'').lower()
+        if encoding in (b'gzip', b'x-gzip'):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == b'deflate':
+            self.decompressor = zlib.decompressobj()
         else:
-            return response
+            self.decompressor = None
+        self.started = False
+
+    def decode(self, data):
+        if self.decompressor is None or not data:
+            return data
+        try:
+            out = self.decompressor.decompress(data)
+        except zlib.error:
+            if self.started:
+                raise
+            # some servers send raw deflate data without the zlib header
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            out = self.decompressor.decompress(data)
+        self.started = True
+        return out
+
+    def flush(self):
+        if self.decompressor is None:
+            return b''
+        return self.decompressor.flush()
+
+
+def parse_content_range(header_str):
+    """
+    :return: (first, last, total) of a "Content-Range: bytes first-last/total" header,
+             first and last are None for "bytes */total", total is None if unknown
+    """
+    value = utils.get_header_value(header_str, b'content-range')
+    match = re.match(rb'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)', value or b'')
+    if match is None:
+        raise ValueError("Invalid Content-Range: {}".format(value))
+    first, last, total = match.groups()
+    return (None if first is None else int(first), None if last is None else int(last),
+            None if total == b'*' else int(total))
+
+
+def retry_after(header_str, default=1.0, limit=30.0):
+    """
+    :return: seconds to wait from the Retry-After header of a response, given in seconds or as a date
+    """
+    value = utils.get_header_value(header_str, b'retry-after')
+    if value is None:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value.decode('ascii')).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return default
+    return min(max(seconds, 0.0), limit)
+
+
+def fetch_when_available(method, url, headers, body='', pool=default_pool, retries=5):
+    """
+    fetch, sent again after Retry-After while the server answers 503 because it is busy
+    """
+    for _ in range(retries):
+        status_code, header_str, response_body = fetch(method, url, headers, body=body, pool=pool)
+        if status_code != 503:
+            return status_code, header_str, response_body
+        time.sleep(retry_after(header_str))
+    return fetch(method, url, headers, body=body, pool=pool)
+
+
+def download_resume(url, path, headers=None, pool=default_pool):
+    """
+    Download url into path, asking only for the bytes after the end of path if it already exists
+    :return: number of bytes written
+    """
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    request_headers = list(headers or [])
+    if offset:
+        request_headers.append('Range: bytes=%d-' % offset)
+    status_code, header_str, body = fetch('get', url, request_headers, pool=pool)
+
+    if status_code == 206:
+        first, _, _ = parse_content_range(header_str)
+        if first != offset:
+            raise ConnectionError("Server resumed at byte %d instead of %d" % (first, offset))
+        with open(path, 'ab') as f:
+            f.write(body)
+        return len(body)
+    if status_code == 416:
+        _, _, total = parse_content_range(header_str)
+        if total == offset:
+            return 0
+        # the file on the server is shorter than the local one, download it again
+        status_code, header_str, body = fetch('get', url, headers, pool=pool)
+    if status_code != 200:
+        raise ConnectionError("Unexpected response status %d" % status_code)
+    with open(path, 'wb') as f:
+        f.write(body)
+    return len(body)
+
+
+def download_parallel(url, path, connections, headers=None):
+    """
+    Download url into path as `connections` ranges fetched at the same time over separate connections.
+    If-Range makes sure all ranges come from the same version of the file.
+    :return: number of bytes written
+    """
+    pool = ConnectionPool(max_per_host=connections)
+    try:
+        status_code, header_str, body = fetch_when_available('get', url, list(headers or []) + ['Range: bytes=0-0'],
+                                                             pool=pool)
+        if status_code == 200:
+            # no range support, the whole file is already here
+            with open(path, 'wb') as f:
+                f.write(body)
+            return len(body)
+        if status_code not in (206, 416):
+            raise ConnectionError("Unexpected response status %d" % status_code)
+
+        _, _, total = parse_content_range(header_str)
+        if total is None:
+            raise ConnectionError("Server did not send the size of the file")
+        etag = utils.get_header_value(header_str, b'etag')
+        with open(path, 'wb') as f:
+            f.truncate(total)
+
+        part_size = max(1, -(-total // connections))
+        errors = []
+
+        def fetch_part(first, last):
+            try:
+                part_headers = list(headers or []) + ['Range: bytes=%d-%d' % (first, last)]
+                if etag:
+                    part_headers.append('If-Range: ' + etag.decode('ascii'))
+                part_status, part_header_str, part_body = fetch_when_available('get', url, part_headers, pool=pool)
+                if part_status == 200:
+                    # If-Range failed, the server sent the whole new version of the file
+                    raise ConnectionError("File changed on the server during the download")
+                if part_status != 206:
+                    raise ConnectionError("Unexpected response status %d for bytes %d-%d" % (part_status, first, last))
+                if parse_content_range(part_header_str)[:2] != (first, last) or len(part_body) != last - first + 1:
+                    raise ConnectionError("Server sent other bytes than %d-%d" % (first, last))
+                with open(path, 'r+b') as f:
+                    f.seek(first)
+                    f.write(part_body)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch_part, args=(first, min(first + part_size, total) - 1))
+                   for first in range(0, total, part_size)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return total
+    finally:
+        pool.close()
+
+
+def run_batch(lines, out, jobs=8, pool=None):
+    """
+    Run the requests of a JSONL manifest concurrently and write one JSON result line per request
+    to `out` as soon as it completes, so results come in completion order; "index" is the 0-based
+    line number of the request. A request is an object like
+        {"method": "post", "url": "localhost:8080/a.txt", "headers": {"append": "True"},
+         "body": "text" or "file": "path to read the body from", "output": "path to write the body to"}
+    Only "url" is required, "method" defaults to get, "headers" can also be a list of "k: v" strings.
+    The body of a response without "output" is put in the result as text.
+    :param lines: iterable of lines, e.g. a file or sys.stdin, read while earlier requests are running
+    :param out: text stream the results are written to
+    :param jobs: max number of requests in flight
+    :return: number of failed requests, a failure is an error or a status >= 400
+    """
+    pool = pool or ConnectionPool(max_per_host=jobs)
+    slots = threading.Semaphore(jobs)
+    lock = threading.Lock()
+    failed = [0]
+
+    def write(result):
+        with lock:
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            if 'error' in result or result.get('status', 0) >= 400:
+                failed[0] += 1
+
+    def run(index, spec):
+        result = {'index': index}
+        start = time.perf_counter()
+        try:
+            result['url'] = spec['url']
+            method = spec.get('method', 'get').lower()
+            if method not in ('get', 'post'):
+                raise ValueError("Unsupported method " + method)
+            headers = spec.get('headers') or []
+            if isinstance(headers, dict):
+                headers = ['%s: %s' % (k, v) for k, v in headers.items()]
+            body = spec.get('body', '')
+            if spec.get('file'):
+                with open(spec['file'], 'rb') as f:
+                    body = f.read()
+            status_code, _, response_body = fetch(method, spec['url'], headers, body=body, pool=pool)
+            result['status'] = status_code
+            result['bytes'] = len(response_body)
+            if spec.get('output'):
+                with open(spec['output'], 'wb') as f:
+                    f.write(response_body)
+                result['output'] = spec['output']
+            else:
+                result['body'] = bytes(response_body).decode('utf-8', 'replace')
+        except Exception as e:
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+        finally:
+            slots.release()
+        result['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        write(result)
+
+    threads = []
+    try:
+        for index, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                spec = json.loads(line)
+                if not isinstance(spec, dict):
+                    raise ValueError("Expected a JSON object")
+            except ValueError as e:
+                write({'index': index, 'error': 'Invalid request line: %s' % e})
+                continue
+            slots.acquire()
+            t = threading.Thread(target=run, args=(index, spec))
+            t.start()
+            threads.append(t)
+            threads = [t for t in threads if t.is_alive()]
+        for t in threads:
+            t.join()
     finally:
-        conn.close()
+        pool.close()
+    return failed[0]
+
 
+def can_resend(msg, sent):
+    """
+    Whether a request that failed on a reused connection may be sent again on another one:
+    if it could not be sent at all, or if it is a GET. The server may have applied any other
+    request, e.g. an append, before closing the connection.
+    :param sent: True if the whole request was written to the connection
+    """
+    return not sent or msg.startswith(b'GET ')
 
-def construct_response(request, response, verbose):
-    status_code = response.split(b" ")[1]
+
+def construct_response(request, header_str, body, verbose):
+    status_code = header_str.split(b" ")[1]
     if verbose:
-        response = request + b'\n\n' + response
+        response = request + b'\n\n' + header_str + b'\r\n\r\n' + body
     else:
-        response = response.split(b'\r\n\r\n')[1]
+        response = bytes(body)
     return response, status_code
 
 
 # construct get request msg, encoding headers in ASCII
 # read parameters from url, append headers list
-def construct_request(method, parsed_url, headers, body=''):
+def construct_request(method, parsed_url, headers, body='', keep_alive=True):
     # print(parsed_url)
     # print(parsed_url.netloc)
 
@@ -58,7 +649,8 @@ def construct_request(method, parsed_url, headers, body=''):
         msg = "GET " + url_without_host + " HTTP/1.1\r\n"
 
         # union default headers and customized headers
-        http_headers = {'Host': parsed_url.netloc, 'User-Agent': 'httpc/1.0', 'Accept': '*/*'}
+        http_headers = {'Host': parsed_url.netloc, 'User-Agent': 'httpc/1.0', 'Accept': '*/*',
+                        'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive' if keep_alive else 'close'}
         if headers:
             customized_headers = utils.parse_str_list_to_dict(headers)
             http_headers.update(customized_headers)
@@ -71,6 +663,7 @@ def construct_request(method, parsed_url, headers, body=''):
     elif method == 'post':
         msg = "POST " + url_without_host + " HTTP/1.1\r\n"
         http_headers = {'Host': parsed_url.netloc, 'User-Agent': 'httpc/1.0', 'Accept': '*/*',
+                        'Connection': 'keep-alive' if keep_alive else 'close',
                         'Content-Type': 'application/x-www-form-urlencoded', 'Content-Length': len(body)}
         if headers:
             customized_headers = utils.parse_str_list_to_dict(headers)
@@ -78,9 +671,262 @@ def construct_request(method, parsed_url, headers, body=''):
         http_headers_str = utils.dict_to_str(http_headers)
         msg += http_headers_str
         msg += '\r\n'
+        if isinstance(body, bytes):
+            return msg.encode(encoding='ascii') + body
         msg += body
         return msg.encode(encoding='ascii')
 
 
+class AsyncPooledConnection:
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    @classmethod
+    async def open(cls, key, timeout=None):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*key), timeout)
+        return cls(key, reader, writer)
+
+    def is_alive(self):
+        """
+        An idle keep-alive connection must have nothing to read, see PooledConnection.is_alive
+        """
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncConnectionPool:
+    """
+    asyncio version of ConnectionPool, to be used from a single event loop
+    """
+    def __init__(self, max_per_host=4, idle_timeout=30, connect_timeout=None):
+        """
+        :param max_per_host: max number of connections (idle + in use) to one (host, port)
+        :param idle_timeout: seconds an idle connection is kept before it is evicted
+        :param connect_timeout: seconds to wait for a new connection, None means no limit
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.idle = dict()    # (host, port) -> list of idle AsyncPooledConnection, most recent last
+        self.in_use = dict()  # (host, port) -> number of connections taken out of the pool
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, key):
+        """
+        Get an idle connection to key, or open a new one if the per-host cap allows it.
+        Wait until a connection is released otherwise.
+        """
+        async with self.cond:
+            while True:
+                self.evict_idle()
+                idle_conns = self.idle.get(key)
+                while idle_conns:
+                    pooled = idle_conns.pop()
+                    if pooled.is_alive():
+                        pooled.reused = True
+                        self.in_use[key] = self.in_use.get(key, 0) + 1
+                        return pooled
+                    pooled.close()
+                if self.in_use.get(key, 0) + len(self.idle.get(key, ())) < self.max_per_host:
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    break
+                await self.cond.wait()
+
+        try:
+            return await AsyncPooledConnection.open(key, self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            await self.release(None, key=key)
+            raise
+
+    async def release(self, pooled, reusable=True, key=None):
+        """
+        Give a connection back to the pool, or close it if it cannot be reused
+        """
+        key = pooled.key if pooled else key
+        async with self.cond:
+            self.in_use[key] -= 1
+            if pooled:
+                if reusable:
+                    pooled.last_used = time.monotonic()
+                    self.idle.setdefault(key, []).append(pooled)
+                else:
+                    pooled.close()
+            self.cond.notify_all()
+
+    def evict_idle(self):
+        """
+        Close connections that have been idle for more than idle_timeout
+        """
+        now = time.monotonic()
+        for key in list(self.idle):
+            alive = []
+            for pooled in self.idle[key]:
+                if now - pooled.last_used > self.idle_timeout:
+                    pooled.close()
+                else:
+                    alive.append(pooled)
+            if alive:
+                self.idle[key] = alive
+            else:
+                del self.idle[key]
+
+    def close(self):
+        for idle_conns in self.idle.values():
+            for pooled in idle_conns:
+                pooled.close()
+        self.idle.clear()
+
+
+async def release_async(pool, pooled, reusable=True):
+    """
+    Give a connection back to pool, or close it if pool is None
+    """
+    if pool is None:
+        pooled.close()
+    else:
+        await pool.release(pooled, reusable=reusable)
+
+
+class AsyncResponse:
+    """
+    Response of request(). Unless it was requested with stream=True, the decoded body is in `body`.
+    A streamed body is read with iter_chunks() or read(); its connection goes back to the pool once
+    the body has been read to the end, call close() to give up on the rest of the body.
+    """
+    def __init__(self, url, header_str, pooled, pool, timeout):
+        self.url = url
+        self.header_str = header_str
+        self.status = int(header_str.split(b' ')[1])
+        self.body = None
+        self.pooled = pooled
+        self.pool = pool
+        self.timeout = timeout
+
+    def header(self, name):
+        """
+        :param name: lower case header name in bytes
+        :return: bytes or None
+        """
+        return utils.get_header_value(self.header_str, name)
+
+    async def iter_chunks(self, chunk_size=utils.BODY_CHUNK_SIZE):
+        """
+        Decoded body in chunks of at most chunk_size bytes (before decompression)
+        """
+        if self.body is not None:
+            if self.body:
+                yield self.body
+            return
+        if self.pooled is None:
+            raise ValueError("Response body has already been consumed")
+        decoder = BodyDecoder(self.header_str)
+        chunks = utils.iter_http_body_async(self.pooled.reader, self.header_str, chunk_size=chunk_size)
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                data = decoder.decode(data)
+                if data:
+                    yield data
+            data = decoder.flush()
+            if data:
+                yield data
+        except BaseException:
+            await self.close()
+            raise
+        await self.finish()
+
+    async def read(self):
+        if self.body is None:
+            body = bytearray()
+            async for data in self.iter_chunks():
+                body += data
+            self.body = bytes(body)
+        return self.body
+
+    async def finish(self):
+        """
+        The whole body has been read, the connection can be reused if the response was framed
+        """
+        pooled, self.pooled = self.pooled, None
+        if pooled is None:
+            return
+        connection = self.header(b'connection')
+        framed = utils.has_no_body(self.header_str) or utils.is_chunked(self.header_str) \
+            or self.header(b'content-length') is not None
+        await release_async(self.pool, pooled, framed and (connection is None or connection.lower() != b'close'))
+
+    async def close(self):
+        """
+        Drop the rest of the body and the connection
+        """
+        pooled, self.pooled = self.pooled, None
+        if pooled is not None:
+            await release_async(self.pool, pooled, reusable=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def request(method, url, headers=None, body='', pool=None, timeout=None, max_redirects=5, stream=False):
+    """
+    asyncio version of fetch. Connections are taken from `pool`, an AsyncConnectionPool,
+    with pool=None a new connection is used and closed after the response.
+    :param timeout: seconds allowed for connecting, sending the request, receiving the header
+                    and each chunk of the body, None means no limit
+    :param stream: True to return as soon as the header has been received, see AsyncResponse
+    :return: AsyncResponse of the final response
+    """
+    for _ in range(max_redirects + 1):
+        if not url.startswith('http://'):
+            url = 'http://' + url
+        parsed_url = urlparse(url)
+        port = 80 if parsed_url.port is None else parsed_url.port
+        key = (parsed_url.hostname, port)
+        msg = construct_request(method, parsed_url, headers, body=body, keep_alive=pool is not None)
 
+        while True:
+            if pool is None:
+                pooled = await AsyncPooledConnection.open(key, timeout)
+            else:
+                pooled = await pool.acquire(key)
+            sent = False
+            try:
+                pooled.writer.write(msg)
+                await asyncio.wait_for(pooled.writer.drain(), timeout)
+                sent = True
+                header_str = await asyncio.wait_for(pooled.reader.readuntil(b'\r\n\r\n'), timeout)
+                break
+            except (OSError, asyncio.IncompleteReadError) as e:
+                await release_async(pool, pooled, reusable=False)
+                # a reused connection may have been closed by the server in the meantime, retry once
+                if pooled.reused and can_resend(msg, sent):
+                    continue
+                if isinstance(e, asyncio.IncompleteReadError):
+                    raise ConnectionError("Server closed the connection without a response")
+                raise
+            except BaseException:
+                await release_async(pool, pooled, reusable=False)
+                raise
 
+        response = AsyncResponse(url, header_str[:-4], pooled, pool, timeout)
+        if response.status in (301, 302, 303, 307, 308) and response.header(b'location'):
+            await response.read()
+            url = response.header(b'location').decode('ascii')
+            body = ''
+            continue
+        if not stream:
+            await response.read()
+        return response
+    raise ConnectionError("Too many redirects")
@@ -0,0 +1,71 @@
+MAX_HEADER_FIELDS = 100
+MAX_LINE_LENGTH = 8190
+
+
+class RequestHeaderTooLarge(ValueError):
+    pass
+
+
+class RequestHeader:
+    """
+    Request line and header fields of a request. Field names are lower-cased once when parsed,
+    repeated fields are joined with ", ".
+    """
+    __slots__ = ('method', 'path', 'http_version', 'fields')
+
+    def __init__(self, method, path, http_version, fields):
+        self.method = method              # upper case bytes, e.g. b'GET'
+        self.path = path                  # request target as sent, with the query string
+        self.http_version = http_version  # e.g. b'HTTP/1.1'
+        self.fields = fields              # lower case name -> value, both bytes
+
+    def get(self, name, default=None):
+        """
+        :param name: lower case header name in bytes
+        """
+        return self.fields.get(name, default)
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __repr__(self):
+        return "RequestHeader(%r, %r, %r, %r)" % (self.method, self.path, self.http_version, self.fields)
+
+
+def parse_request_header(header_str, max_fields=MAX_HEADER_FIELDS, max_line=MAX_LINE_LENGTH):
+    """
+    Parse the request line and header fields of a request in one pass over its lines
+    :param header_str: bytes up to, not including, the blank line
+    :param max_fields: max number of header fields
+    :param max_line: max length of the request line and of each header line
+    :return: RequestHeader
+    :raise RequestHeaderTooLarge: if a limit is exceeded
+    :raise ValueError: if the request line or a header line is malformed
+    """
+    lines = header_str.split(b'\r\n')
+    if len(lines) - 1 > max_fields:
+        raise RequestHeaderTooLarge("More than {} header fields".format(max_fields))
+
+    request_line = lines[0]
+    if len(request_line) > max_line:
+        raise RequestHeaderTooLarge("Request line is longer than {} bytes".format(max_line))
+    parts = request_line.split(b' ')
+    if len(parts) != 3 or not parts[0] or not parts[1] or not parts[2].startswith(b'HTTP/'):
+        raise ValueError("Malformed request line: {!r}".format(request_line))
+
+    fields = dict()
+    for line in lines[1:]:
+        if len(line) > max_line:
+            raise RequestHeaderTooLarge("Header line is longer than {} bytes".format(max_line))
+        name, sep, value = line.partition(b':')
+        # no whitespace is allowed between the field name and the colon
+        if not sep or not name or name[-1] in b' \t':
+            raise ValueError("Malformed header line: {!r}".format(line))
+        name = name.lower()
+        value = value.strip()
+        if name in fields:
+            fields[name] += b', ' + value
+        else:
+            fields[name] = value
+
+    return RequestHeader(parts[0].upper(), parts[1], parts[2], fields)
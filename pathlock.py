@@ -0,0 +1,147 @@
+import errno
+import fcntl
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """
+    Any number of readers or a single writer. Waiting writers block new readers,
+    so a steady stream of GETs cannot starve a POST.
+    """
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+        self.shared = None  # (file, offset) of a byte also locked against other processes, see PathLockManager
+
+    def lock_shared(self, kind):
+        # fcntl record locks belong to the process, so the first reader takes the shared lock
+        # for all threads and the last one releases it
+        if self.shared is None:
+            return
+        f, offset = self.shared
+        delay = 0.001
+        while True:
+            try:
+                fcntl.lockf(f, kind, 1, offset)
+                return
+            except OSError as e:
+                if e.errno != errno.EDEADLK:
+                    raise
+            # the kernel sees the locks of all threads of a process as held by one owner, so a reader
+            # in each of two workers and a writer waiting behind the other looks like a deadlock.
+            # It is not one, a thread holds a single stripe at a time, so the reader will release it
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            if self.readers == 0:
+                self.lock_shared(fcntl.LOCK_SH)
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.lock_shared(fcntl.LOCK_UN)
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            self.lock_shared(fcntl.LOCK_EX)
+        except BaseException:
+            self.release_write()
+            raise
+
+    def release_write(self):
+        with self.cond:
+            self.lock_shared(fcntl.LOCK_UN)
+            self.writer = False
+            self.cond.notify_all()
+
+
+class PathLockManager:
+    """
+    Reader/writer locks by path. Paths are hashed onto a fixed table of locks, so memory does not grow
+    with the number of paths; two paths sharing a stripe only means they are locked together.
+    """
+    def __init__(self, stripes=256):
+        self.stripes = [ReadWriteLock() for _ in range(stripes)]
+        self.lock = threading.Lock()  # guards the counters
+
+        self.reads = 0
+        self.writes = 0
+        self.read_waits = 0         # acquisitions that had to wait
+        self.write_waits = 0
+        self.read_wait_time = 0.0   # seconds spent waiting
+        self.write_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def share_with_children(self):
+        """
+        Also lock against the processes forked after this call: stripe i locks byte i of an unnamed
+        temporary file with fcntl record locks, besides its lock within the process
+        """
+        lock_file = tempfile.TemporaryFile()
+        for offset, stripe in enumerate(self.stripes):
+            stripe.shared = (lock_file, offset)
+
+    def stripe(self, path):
+        return self.stripes[hash(path) % len(self.stripes)]
+
+    @contextmanager
+    def read(self, path):
+        stripe = self.stripe(path)
+        start = time.monotonic()
+        stripe.acquire_read()
+        self.record(False, time.monotonic() - start)
+        try:
+            yield
+        finally:
+            stripe.release_read()
+
+    @contextmanager
+    def write(self, path):
+        stripe = self.stripe(path)
+        start = time.monotonic()
+        stripe.acquire_write()
+        self.record(True, time.monotonic() - start)
+        try:
+            yield
+        finally:
+            stripe.release_write()
+
+    def record(self, write, waited):
+        # an uncontended acquire takes a few microseconds, count anything longer as a wait
+        waited = waited if waited > 1e-4 else 0.0
+        with self.lock:
+            if write:
+                self.writes += 1
+                self.write_waits += waited > 0
+                self.write_wait_time += waited
+            else:
+                self.reads += 1
+                self.read_waits += waited > 0
+                self.read_wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+    def stats(self):
+        with self.lock:
+            return {'reads': self.reads, 'writes': self.writes,
+                    'read_waits': self.read_waits, 'write_waits': self.write_waits,
+                    'read_wait_ms': round(self.read_wait_time * 1000, 3),
+                    'write_wait_ms': round(self.write_wait_time * 1000, 3),
+                    'max_wait_ms': round(self.max_wait_time * 1000, 3)}
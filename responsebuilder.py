@@ -0,0 +1,83 @@
+import time
+from email.utils import formatdate
+from http import HTTPStatus
+
+
+def make_status_line(status):
+    try:
+        reason = HTTPStatus(status).phrase
+    except ValueError:
+        reason = 'Unknown'
+    return ('HTTP/1.1 %d %s\r\n' % (status, reason)).encode('ascii')
+
+
+STATUS_LINES = {s.value: make_status_line(s.value) for s in HTTPStatus}
+
+
+class ResponseBuilder:
+    """
+    Builds response headers from precomputed pieces: status lines, the static header block,
+    Content-Type lines and a Date line refreshed at most once per second. The header is returned
+    as a list of bytes, to be sent together with the body by one sendmsg (see utils.sendmsg_all).
+    """
+    def __init__(self, server=b'httpfs'):
+        self.static_block = (b"Server: " + server + b"\r\n"
+                             b"Access-Control-Allow-Origin: *\r\n"
+                             b"Access-Control-Allow-Credentials: true\r\n")
+        self.connection_lines = {True: b"Connection: keep-alive\r\n", False: b"Connection: close\r\n"}
+        self.content_type_lines = {'text/plain': b"Content-Type: text/plain\r\n"}
+        self.date = (None, None)  # (second, Date line), replaced as a whole so threads never see half of it
+
+    def date_line(self):
+        now = int(time.time())
+        second, line = self.date
+        if second != now:
+            line = b"Date: " + formatdate(now, usegmt=True).encode('ascii') + b"\r\n"
+            self.date = (now, line)
+        return line
+
+    def status_line(self, status):
+        line = STATUS_LINES.get(status)
+        if line is None:
+            line = STATUS_LINES.setdefault(status, make_status_line(status))
+        return line
+
+    def content_type_line(self, content_type):
+        line = self.content_type_lines.get(content_type)
+        if line is None:
+            line = b"Content-Type: " + content_type.encode('ascii') + b"\r\n"
+            if len(self.content_type_lines) < 256:
+                self.content_type_lines[content_type] = line
+        return line
+
+    def build(self, status, content_length, keep_alive=True, extra_headers=None):
+        """
+        :param status: any status code
+        :param content_length: length of the body, not sent for 304, None for a chunked body
+        :param extra_headers: dict of more headers, 'Content-Type' replaces the default text/plain
+        :return: list of bytes, the header up to and including the blank line
+        """
+        content_type = 'text/plain'
+        extra = b""
+        if extra_headers:
+            lines = []
+            for k, v in extra_headers.items():
+                if k == 'Content-Type':
+                    content_type = v
+                else:
+                    lines.append(k + ': ' + str(v) + '\r\n')
+            extra = ''.join(lines).encode('ascii')
+
+        pieces = [self.status_line(status), self.date_line(), self.content_type_line(content_type)]
+        if status == 304:
+            pass
+        elif content_length is None:
+            pieces.append(b"Transfer-Encoding: chunked\r\n")
+        else:
+            pieces.append(b"Content-Length: %d\r\n" % content_length)
+        pieces.append(self.connection_lines[keep_alive])
+        pieces.append(self.static_block)
+        if extra:
+            pieces.append(extra)
+        pieces.append(b"\r\n")
+        return pieces
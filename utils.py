@@ -1,12 +1,333 @@
+import asyncio
 
-def recvall(conn, buffsize):
-    data = b''
+
+MAX_HEADER_SIZE = 64 * 1024
+BODY_CHUNK_SIZE = 64 * 1024
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+class SocketReader:
+    """
+    Buffered reader on top of a socket. Data is received with recv_into into a preallocated
+    bytearray, bytes received past the end of one message are kept for the next read,
+    so several (pipelined) messages can be read from one connection.
+    """
+    def __init__(self, conn, buffsize=4096):
+        self.conn = conn
+        self.buff = bytearray(buffsize)
+        self.view = memoryview(self.buff)
+        self.start = 0  # first unread byte in buff
+        self.end = 0    # end of received bytes in buff
+
+    def buffered(self):
+        return self.end - self.start
+
+    def fill(self):
+        """
+        Receive more bytes at the end of the buffer, compacting or growing it if it is full
+        :return: number of bytes received, 0 if the peer closed the connection
+        """
+        if self.end == len(self.buff):
+            n = self.end - self.start
+            if self.start > 0:
+                self.buff[:n] = self.buff[self.start:self.end]
+            else:
+                buff = bytearray(2 * len(self.buff))
+                buff[:n] = self.view[:n]
+                self.buff, self.view = buff, memoryview(buff)
+            self.start, self.end = 0, n
+        received = self.conn.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def read_until(self, delimiter, limit=MAX_HEADER_SIZE):
+        """
+        Read up to and including delimiter, every byte is searched only once
+        :param delimiter: bytes
+        :param limit: max number of bytes before the delimiter
+        :return: bytes, or b'' if the peer closed the connection before sending anything
+        """
+        scanned = 0  # bytes after start known not to contain the delimiter
+        while True:
+            index = self.buff.find(delimiter, self.start + scanned, self.end)
+            if index >= 0:
+                data = bytes(self.view[self.start:index + len(delimiter)])
+                self.start = index + len(delimiter)
+                return data
+            scanned = max(0, self.buffered() - len(delimiter) + 1)
+            if scanned > limit:
+                raise ValueError("Message header is larger than {} bytes".format(limit))
+            if not self.fill():
+                if self.buffered():
+                    raise ConnectionError("Connection closed in the middle of a message")
+                return b''
+
+    def read_exact(self, n):
+        """
+        Read exactly n bytes into a bytearray allocated once
+        :param n: number of bytes
+        :return: bytearray
+        """
+        data = bytearray(n)
+        view = memoryview(data)
+        got = min(n, self.buffered())
+        view[:got] = self.view[self.start:self.start + got]
+        self.start += got
+        while got < n:
+            received = self.conn.recv_into(view[got:])
+            if not received:
+                raise ConnectionError("Connection closed in the middle of a message")
+            got += received
+        return data
+
+    def read_some(self, n):
+        """
+        Read at least 1 and at most n bytes, from the buffer if it is not empty,
+        otherwise with one recv
+        :param n: max number of bytes
+        :return: bytes
+        """
+        if self.buffered():
+            got = min(n, self.buffered())
+            data = bytes(self.view[self.start:self.start + got])
+            self.start += got
+            return data
+        data = self.conn.recv(n)
+        if not data:
+            raise ConnectionError("Connection closed in the middle of a message")
+        return data
+
+    def read_to_end(self):
+        """
+        Read until the peer closes the connection
+        :return: bytearray
+        """
+        data = bytearray(self.view[self.start:self.end])
+        self.start = self.end
+        while self.fill():
+            data += self.view[self.start:self.end]
+            self.start = self.end
+        return data
+
+
+def get_header_value(header_str, name):
+    """
+    Find the value of header `name` in a raw header block, case-insensitively
+    :param header_str: bytes, header lines separated by CRLF
+    :param name: bytes, header name
+    :return: bytes or None
+    """
+    for line in header_str.split(b'\r\n')[1:]:
+        k, sep, v = line.partition(b':')
+        if sep and k.strip().lower() == name.lower():
+            return v.strip()
+    return None
+
+
+def read_http_head(reader):
+    """
+    Read the request/status line and headers of one HTTP message
+    :param reader: SocketReader
+    :return: header_str without the blank line, b'' if the connection was closed
+    """
+    head = reader.read_until(b'\r\n\r\n')
+    return head[:-4] if head else b''
+
+
+def is_chunked(header_str):
+    transfer_encoding = get_header_value(header_str, b'transfer-encoding')
+    return transfer_encoding is not None and transfer_encoding.lower().endswith(b'chunked')
+
+
+def has_no_body(header_str):
+    """
+    1xx, 204 and 304 responses never have a body
+    """
+    status_code = header_str.split(b' ', 2)[1]
+    return status_code.startswith(b'1') or status_code in (b'204', b'304')
+
+
+def iter_chunked_body(reader, chunk_size=BODY_CHUNK_SIZE):
+    """
+    Decode a body sent with Transfer-Encoding: chunked
+    :param reader: SocketReader
+    :return: generator of bytes, each at most chunk_size long
+    """
     while True:
-        part = conn.recv(buffsize)
-        data += part
-        if len(part) < buffsize:
-            break
-    return data
+        size_line = reader.read_until(b'\r\n')
+        if not size_line:
+            raise ConnectionError("Connection closed in the middle of a message")
+        size = int(size_line.split(b';')[0].strip(), 16)
+        if size == 0:
+            # skip trailer headers up to the final empty line
+            while reader.read_until(b'\r\n') not in (b'\r\n', b''):
+                pass
+            return
+        while size > 0:
+            data = reader.read_some(min(size, chunk_size))
+            size -= len(data)
+            yield data
+        reader.read_exact(2)
+
+
+def iter_http_body(reader, header_str, is_request=False, max_size=None, chunk_size=BODY_CHUNK_SIZE):
+    """
+    Stream the body of a message whose header was read with read_http_head.
+    The body has to be consumed before the next message is read from reader.
+    :param reader: SocketReader
+    :param header_str: header of the message
+    :param is_request: True if reading a request
+    :param max_size: raise BodyTooLarge if the body is larger than max_size bytes
+    :param chunk_size: max length of each piece
+    :return: generator of bytes
+    """
+    if not is_request and has_no_body(header_str):
+        return
+
+    if is_chunked(header_str):
+        total = 0
+        for data in iter_chunked_body(reader, chunk_size):
+            total += len(data)
+            if max_size is not None and total > max_size:
+                raise BodyTooLarge("Body is larger than {} bytes".format(max_size))
+            yield data
+        return
+
+    content_length = get_header_value(header_str, b'content-length')
+    if content_length is None:
+        if not is_request:
+            yield reader.read_to_end()
+        return
+
+    remaining = int(content_length)
+    if max_size is not None and remaining > max_size:
+        raise BodyTooLarge("Body is larger than {} bytes".format(max_size))
+    while remaining > 0:
+        data = reader.read_some(min(remaining, chunk_size))
+        remaining -= len(data)
+        yield data
+
+
+def recv_http_message(reader, is_request=False):
+    """
+    Read one HTTP message from a SocketReader. The header is read up to the blank line,
+    the body is framed by Transfer-Encoding: chunked or Content-Length. A response without
+    either is read until the peer closes the connection, a request without either has no body.
+    :param reader: SocketReader
+    :param is_request: True if reading a request
+    :return: (header_str, body, framed), header_str is b'' if the connection was closed,
+             framed is False if the end of the message was the end of the connection
+    """
+    header_str = read_http_head(reader)
+    if not header_str:
+        return b'', b'', False
+
+    if not is_request and has_no_body(header_str):
+        return header_str, b'', True
+
+    if is_chunked(header_str):
+        body = bytearray()
+        for data in iter_chunked_body(reader):
+            body += data
+        return header_str, body, True
+
+    content_length = get_header_value(header_str, b'content-length')
+    if content_length is None:
+        if is_request:
+            return header_str, b'', True
+        return header_str, reader.read_to_end(), False
+    return header_str, reader.read_exact(int(content_length)), True
+
+
+async def read_http_head_async(reader):
+    """
+    Read the request/status line and headers of one HTTP message from an asyncio.StreamReader
+    :return: header_str without the blank line, b'' if the connection was closed
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("Connection closed in the middle of a message")
+        return b''
+    except asyncio.LimitOverrunError:
+        raise ValueError("Message header is larger than the stream limit")
+    return head[:-4]
+
+
+async def iter_http_body_async(reader, header_str, is_request=False, max_size=None, chunk_size=BODY_CHUNK_SIZE):
+    """
+    Stream the body of a message from an asyncio.StreamReader, framed like iter_http_body.
+    The body has to be consumed before the next message is read from reader.
+    :param reader: asyncio.StreamReader
+    :return: async generator of bytes
+    """
+    if not is_request and has_no_body(header_str):
+        return
+
+    try:
+        if is_chunked(header_str):
+            total = 0
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0].strip(), 16)
+                if size == 0:
+                    while await reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    return
+                total += size
+                if max_size is not None and total > max_size:
+                    raise BodyTooLarge("Body is larger than {} bytes".format(max_size))
+                while size > 0:
+                    data = await reader.readexactly(min(size, chunk_size))
+                    size -= len(data)
+                    yield data
+                await reader.readexactly(2)
+
+        content_length = get_header_value(header_str, b'content-length')
+        if content_length is None:
+            if not is_request:
+                while True:
+                    data = await reader.read(chunk_size)
+                    if not data:
+                        return
+                    yield data
+            return
+
+        remaining = int(content_length)
+        if max_size is not None and remaining > max_size:
+            raise BodyTooLarge("Body is larger than {} bytes".format(max_size))
+        while remaining > 0:
+            data = await reader.readexactly(min(remaining, chunk_size))
+            remaining -= len(data)
+            yield data
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed in the middle of a message")
+    except asyncio.LimitOverrunError:
+        raise ValueError("Chunk size line is larger than the stream limit")
+
+
+def sendmsg_all(conn, buffers):
+    """
+    Send a list of bytes-like objects with sendmsg (scatter/gather), without joining them first
+    :param conn: socket
+    :param buffers: list of bytes-like
+    """
+    if not hasattr(conn, 'sendmsg'):
+        conn.sendall(b"".join(buffers))
+        return
+    views = [memoryview(b) for b in buffers if len(b)]
+    while views:
+        sent = conn.sendmsg(views)
+        # drop what has been sent, sendmsg may stop in the middle of a buffer
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
 
 
 def dict_to_str(headers):